@@ -1,43 +1,91 @@
 import torch
-import random, numpy as np
+import random, shutil, numpy as np
+from functools import partial
 from pathlib import Path
 
 from neural import MarioNet
-from collections import deque
+from checkpoint import CheckpointWriter
+from profiler import Profiler
+from memory import ReplayBuffer, PrioritizedReplayBuffer, BatchSampler
 
 
 class Mario:
-    def __init__(self, state_dim, action_dim, save_dir, checkpoint=None):
+    def __init__(self, state_dim, action_dim, save_dir, checkpoint=None, replay_dir=None, prioritized=False, prefetch=True, n_step=1, save_replay=False, compile_mode=None, channels_last=False, precision='fp32',
+                 batch_size=32, updates_per_learn=1, replay_ratio=None, lr_scaling=None, schedule_on='env_steps',
+                 keep_last=None, keep_every=None, profiler=None):
         self.state_dim = state_dim
         self.action_dim = action_dim
-        self.memory = deque(maxlen=100000)
-        self.batch_size = 32
+        self.batch_size = batch_size
 
         self.exploration_rate = 1
         self.exploration_rate_decay = 0.99999975
         self.exploration_rate_min = 0.1
         self.gamma = 0.9
+        self.n_step = n_step  # no. of rewards summed before bootstrapping from Q_target
+
+        # replay_dir keeps the replay buffer in memory-mapped files instead of RAM
+        self.prioritized = prioritized
+        memory_cls = PrioritizedReplayBuffer if prioritized else ReplayBuffer
+        self.memory = memory_cls(100000, self.state_dim, storage_dir=replay_dir, n_step=self.n_step, gamma=self.gamma)
 
         self.curr_step = 0
+        self.last_learn_step = 0  # curr_step at the previous call to learn()
         self.burnin = 1e5  # min. experiences before training
         self.learn_every = 3   # no. of experiences between updates to Q_online
+        self.updates_per_learn = updates_per_learn  # no. of gradient updates each time learn_every is reached
+        if replay_ratio:
+            # replay_ratio sampled transitions per env step, whatever the batch size
+            self.learn_every = self.updates_per_learn * self.batch_size / replay_ratio
         self.sync_every = 1e4   # no. of experiences between Q_target & Q_online sync
 
         self.save_every = 1e5  # no. of experiences between saving Mario Net
+        # 'updates' counts sync_every and save_every in gradient updates instead of experiences
+        if schedule_on not in ('env_steps', 'updates'):
+            raise ValueError(f"Unknown schedule: {schedule_on}")
+        self.schedule_on = schedule_on
+        self.grad_step = 0  # no. of gradient updates to Q_online
         self.save_dir = save_dir
+        self.save_replay = save_replay  # snapshot the replay buffer next to each checkpoint
+        self.replay_snapshot = None
+        # keep_last/keep_every prune older checkpoints, see CheckpointWriter
+        self.checkpoints = CheckpointWriter(save_dir, keep_last=keep_last, keep_every=keep_every)
+        # times recall, forward, backward, optimizer, sync and save, see profiler.py
+        self.profiler = profiler if profiler is not None else Profiler(enabled=False)
 
         self.use_cuda = torch.cuda.is_available()
+        # prefetch samples the next batch on a background thread during the gradient step
+        self.sampler = BatchSampler(self.memory, self.batch_size, pin_memory=self.use_cuda, prefetch=prefetch)
 
         # Mario's DNN to predict the most optimal action - we implement this in the Learn section
         self.net = MarioNet(self.state_dim, self.action_dim).float()
         if self.use_cuda:
             self.net = self.net.to(device='cuda')
+        # compile_mode is 'trace', 'script' or 'compile', see MarioNet.compile_heads, None runs eager
+        if compile_mode:
+            device = 'cuda' if self.use_cuda else 'cpu'
+            self.net.compile_heads(compile_mode, torch.zeros((1, *self.state_dim), device=device), channels_last=channels_last)
+
+        # 'bf16' runs the forward/backward passes of the learn step under autocast,
+        # the weights and the Adam state stay fp32
+        if precision not in ('fp32', 'bf16'):
+            raise ValueError(f"Unknown precision: {precision}")
+        self.precision = precision
+        # row indices of a batch, allocated once instead of per update
+        self.batch_range = torch.arange(self.batch_size, device='cuda' if self.use_cuda else 'cpu')
+        # lr_scaling 'linear' or 'sqrt' scales the learning rate with batch_size / 32
+        self.lr = 0.00025
+        if lr_scaling == 'linear':
+            self.lr *= self.batch_size / 32
+        elif lr_scaling == 'sqrt':
+            self.lr *= (self.batch_size / 32) ** 0.5
+        elif lr_scaling is not None:
+            raise ValueError(f"Unknown lr_scaling: {lr_scaling}")
+        self.optimizer = torch.optim.Adam(self.net.parameters(), lr=self.lr)
+        self.loss_fn = torch.nn.SmoothL1Loss(reduction='none')
+
         if checkpoint:
             self.load(checkpoint)
 
-        self.optimizer = torch.optim.Adam(self.net.parameters(), lr=0.00025)
-        self.loss_fn = torch.nn.SmoothL1Loss()
-
 
     def act(self, state):
         """
@@ -54,7 +102,8 @@ class Mario:
 
         # EXPLOIT
         else:
-            state = torch.FloatTensor(state).cuda() if self.use_cuda else torch.FloatTensor(state)
+            state = torch.as_tensor(np.asarray(state))
+            state = state.cuda() if self.use_cuda else state
             state = state.unsqueeze(0)
             action_values = self.net(state, model='online')
             action_idx = torch.argmax(action_values, axis=1).item()
@@ -67,7 +116,38 @@ class Mario:
         self.curr_step += 1
         return action_idx
 
-    def cache(self, state, next_state, action, reward, done):
+    def act_batch(self, states, exploration_rates=None):
+        """
+        Choose epsilon-greedy actions for N envs with a single forward pass.
+
+        Inputs:
+        states (array): Observations of the N envs, dimension is (N, *state_dim)
+        exploration_rates (array): Optional per-env epsilon, defaults to self.exploration_rate for all envs
+        Outputs:
+        action_idx (array of int): The action of each env
+        """
+        num_envs = len(states)
+        if exploration_rates is None:
+            exploration_rates = np.full(num_envs, self.exploration_rate)
+        explore = np.random.rand(num_envs) < exploration_rates
+        action_idx = np.random.randint(self.action_dim, size=num_envs)
+
+        if not explore.all():
+            states = torch.as_tensor(np.asarray(states))
+            states = states.cuda() if self.use_cuda else states
+            with torch.no_grad():
+                action_values = self.net(states, model='online')
+            greedy = torch.argmax(action_values, axis=1).cpu().numpy()
+            action_idx = np.where(explore, action_idx, greedy)
+
+        # decrease exploration_rate once per env step
+        self.exploration_rate *= self.exploration_rate_decay ** num_envs
+        self.exploration_rate = max(self.exploration_rate_min, self.exploration_rate)
+
+        self.curr_step += num_envs
+        return action_idx
+
+    def cache(self, state, next_state, action, reward, done, env=0, frame_ids=None):
         """
         Store the experience to self.memory (replay buffer)
 
@@ -76,28 +156,31 @@ class Mario:
         next_state (LazyFrame),
         action (int),
         reward (float),
-        done(bool))
+        done(bool),
+        env (int): index of the env in vectorized mode
+        frame_ids (array): info['frame_ids'] from RingFrameStack, lets memory skip frames it already holds
         """
-        state = torch.FloatTensor(state).cuda() if self.use_cuda else torch.FloatTensor(state)
-        next_state = torch.FloatTensor(next_state).cuda() if self.use_cuda else torch.FloatTensor(next_state)
-        action = torch.LongTensor([action]).cuda() if self.use_cuda else torch.LongTensor([action])
-        reward = torch.DoubleTensor([reward]).cuda() if self.use_cuda else torch.DoubleTensor([reward])
-        done = torch.BoolTensor([done]).cuda() if self.use_cuda else torch.BoolTensor([done])
-
-        self.memory.append( (state, next_state, action, reward, done,) )
+        self.memory.add(state, next_state, action, reward, done, stream=env, frame_ids=frame_ids)
 
 
     def recall(self):
         """
         Retrieve a batch of experiences from memory
+
+        The transition numbers and importance-sampling weights (None unless prioritized)
+        of the batch are kept in self.batch_idx and self.batch_weights.
         """
-        batch = random.sample(self.memory, self.batch_size)
-        state, next_state, action, reward, done = map(torch.stack, zip(*batch))
-        return state, next_state, action.squeeze(), reward.squeeze(), done.squeeze()
+        self.batch_idx, weights, state, next_state, action, reward, done = self.sampler.get()
+        self.batch_weights = weights
+        if self.use_cuda:
+            state, next_state, action, reward, done = (t.cuda(non_blocking=True) for t in (state, next_state, action, reward, done))
+            if weights is not None:
+                self.batch_weights = weights.cuda(non_blocking=True)
+        return state, next_state, action, reward, done
 
 
     def td_estimate(self, state, action):
-        current_Q = self.net(state, model='online')[np.arange(0, self.batch_size), action] # Q_online(s,a)
+        current_Q = self.net(state, model='online')[self.batch_range, action] # Q_online(s,a)
         return current_Q
 
 
@@ -105,70 +188,225 @@ class Mario:
     def td_target(self, reward, next_state, done):
         next_state_Q = self.net(next_state, model='online')
         best_action = torch.argmax(next_state_Q, axis=1)
-        next_Q = self.net(next_state, model='target')[np.arange(0, self.batch_size), best_action]
-        return (reward + (1 - done.float()) * self.gamma * next_Q).float()
+        next_Q = self.net(next_state, model='target')[self.batch_range, best_action]
+        return reward + (1 - done.float()) * self.gamma ** self.n_step * next_Q.float()
 
 
-    def update_Q_online(self, td_estimate, td_target) :
+    def update_Q_online(self, td_estimate, td_target, weights=None) :
         loss = self.loss_fn(td_estimate, td_target)
+        if weights is not None:
+            loss = loss * weights
+        loss = loss.mean()
         self.optimizer.zero_grad()
-        loss.backward()
-        self.optimizer.step()
+        with self.profiler.phase('backward'):
+            loss.backward()
+        with self.profiler.phase('optimizer'):
+            self.optimizer.step()
         return loss.item()
 
 
     def sync_Q_target(self):
-        self.net.target.load_state_dict(self.net.online.state_dict())
+        with self.profiler.phase('sync'):
+            self.net.target.load_state_dict(self.net.online.state_dict())
+            self.net.refresh()
 
 
     def learn(self):
-        if self.curr_step % self.sync_every == 0:
-            self.sync_Q_target()
+        """
+        Run the updates due since the previous call.
+
+        act_batch() advances curr_step by several steps at once, so the schedules
+        fire whenever curr_step crosses a multiple of their period. Each crossing
+        of learn_every runs updates_per_learn gradient updates. With
+        schedule_on='updates', update() syncs and saves on gradient updates instead.
+        """
+        last_step, self.last_learn_step = self.last_learn_step, self.curr_step
 
-        if self.curr_step % self.save_every == 0:
-            self.save()
+        def crossed(every):
+            return int(self.curr_step // every - last_step // every)
+
+        if self.schedule_on == 'env_steps':
+            if crossed(self.sync_every):
+                self.sync_Q_target()
+
+            if crossed(self.save_every):
+                self.save()
 
         if self.curr_step < self.burnin:
             return None, None
 
-        if self.curr_step % self.learn_every != 0:
+        updates = crossed(self.learn_every) * self.updates_per_learn
+        if not updates:
             return None, None
 
+        qs, losses = zip(*(self.update() for _ in range(updates)))
+        return (np.mean(qs), np.mean(losses))
+
+
+    def update(self):
+        """Run one gradient step on a batch sampled from memory, returns (mean Q, loss)"""
         # Sample from memory
-        state, next_state, action, reward, done = self.recall()
+        with self.profiler.phase('recall'):
+            state, next_state, action, reward, done = self.recall()
 
-        # Get TD Estimate
-        td_est = self.td_estimate(state, action)
+        device_type = 'cuda' if self.use_cuda else 'cpu'
+        with self.profiler.phase('forward'), torch.autocast(device_type, dtype=torch.bfloat16, enabled=self.precision == 'bf16'):
+            # Get TD Estimate
+            td_est = self.td_estimate(state, action)
 
-        # Get TD Target
-        td_tgt = self.td_target(reward, next_state, done)
+            # Get TD Target
+            td_tgt = self.td_target(reward, next_state, done)
+            td_est = td_est.float()
 
         # Backpropagate loss through Q_online
-        loss = self.update_Q_online(td_est, td_tgt)
+        loss = self.update_Q_online(td_est, td_tgt, self.batch_weights)
+
+        # Refresh priorities from the TD errors
+        if self.prioritized:
+            self.memory.update_priorities(self.batch_idx, (td_tgt - td_est).detach().abs().cpu().numpy())
+
+        self.grad_step += 1
+        if self.schedule_on == 'updates':
+            if self.grad_step % self.sync_every == 0:
+                self.sync_Q_target()
+            if self.grad_step % self.save_every == 0:
+                self.save()
 
         return (td_est.mean().item(), loss)
 
 
     def save(self):
-        save_path = self.save_dir / f"mario_net_{int(self.curr_step // self.save_every)}.chkpt"
-        torch.save(
+        """
+        Queue a checkpoint of the full training state, written by a background thread
+
+        Besides the weights and exploration rate it holds the optimizer state,
+        the step counters and the RNG states, so load() resumes where it stopped.
+        The replay buffer is flushed, and snapshotted with save_replay, on the
+        same thread while training goes on.
+        """
+        with self.profiler.phase('save'):
+            self._save()
+
+
+    def _save(self):
+        step = self.grad_step if self.schedule_on == 'updates' else self.curr_step
+        save_path = self.save_dir / f"mario_net_{int(step // self.save_every)}.chkpt"
+        self.checkpoints.write(
             dict(
                 model=self.net.state_dict(),
-                exploration_rate=self.exploration_rate
+                exploration_rate=self.exploration_rate,
+                optimizer=self.optimizer.state_dict(),
+                curr_step=self.curr_step,
+                grad_step=self.grad_step,
+                last_learn_step=self.last_learn_step,
+                rng=self.rng_state()
             ),
-            save_path
+            save_path,
+            after=partial(self._save_memory, save_path)
         )
-        print(f"MarioNet saved to {save_path} at step {self.curr_step}")
+
+
+    def _save_memory(self, save_path):
+        self.memory.flush()
+
+        if self.save_replay:
+            # only the latest snapshot is kept, each one holds the whole buffer
+            replay_path = save_path.with_suffix('.replay')
+            self.memory.save(replay_path)
+            if self.replay_snapshot is not None and self.replay_snapshot != replay_path:
+                shutil.rmtree(self.replay_snapshot, ignore_errors=True)
+            self.replay_snapshot = replay_path
+            print(f"Replay buffer saved to {replay_path} with {len(self.memory)} experiences")
 
 
     def load(self, load_path):
         if not load_path.exists():
             raise ValueError(f"{load_path} does not exist")
 
-        ckp = torch.load(load_path, map_location=('cuda' if self.use_cuda else 'cpu'))
+        # the RNG states must stay CPU ByteTensors, the weights and optimizer state are copied to the GPU by load_state_dict
+        ckp = torch.load(load_path, map_location='cpu')
         exploration_rate = ckp.get('exploration_rate')
         state_dict = ckp.get('model')
 
         print(f"Loading model at {load_path} with exploration rate {exploration_rate}")
         self.net.load_state_dict(state_dict)
+        self.net.refresh()
         self.exploration_rate = exploration_rate
+
+        # checkpoints from before the full training state only hold the above
+        if 'optimizer' in ckp:
+            self.optimizer.load_state_dict(ckp['optimizer'])
+            for group in self.optimizer.param_groups:
+                group['lr'] = self.lr
+            self.curr_step = ckp['curr_step']
+            self.grad_step = ckp['grad_step']
+            self.last_learn_step = ckp['last_learn_step']
+            self.set_rng_state(ckp['rng'])
+            print(f"Resuming at step {self.curr_step} after {self.grad_step} updates")
+
+        replay_path = load_path.with_suffix('.replay')
+        if replay_path.exists():
+            self.memory.restore(replay_path)
+            # the restored experiences replace the burn-in period
+            self.burnin = 0
+
+
+    def rng_state(self):
+        """RNG states of torch, numpy, random and the replay buffer, as tensors and plain values"""
+        name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        return dict(
+            torch=torch.get_rng_state(),
+            cuda=torch.cuda.get_rng_state_all() if self.use_cuda else None,
+            numpy=dict(keys=torch.from_numpy(keys.astype(np.int64)), pos=pos, has_gauss=has_gauss, cached_gaussian=cached_gaussian),
+            random=random.getstate(),
+            memory=self.memory.rng.bit_generator.state
+        )
+
+
+    def set_rng_state(self, state):
+        torch.set_rng_state(state['torch'])
+        if self.use_cuda and state['cuda'] is not None:
+            torch.cuda.set_rng_state_all(state['cuda'])
+        numpy = state['numpy']
+        np.random.set_state(('MT19937', numpy['keys'].numpy().astype(np.uint32), numpy['pos'], numpy['has_gauss'], numpy['cached_gaussian']))
+        random.setstate(state['random'])
+        self.memory.rng.bit_generator.state = state['memory']
+
+
+class MarioPolicy:
+    '''Inference-only Mario: the online network of a checkpoint, without target, optimizer or replay buffer
+
+    The checkpoint is memory-mapped and only the online weights are assigned
+    to a network built on the meta device, so no weights are initialized or
+    copied at startup.
+    '''
+    def __init__(self, checkpoint, state_dim, action_dim, exploration_rate=None):
+        ckp = torch.load(checkpoint, map_location='cpu', mmap=True, weights_only=True)
+        with torch.device('meta'):
+            self.net = MarioNet(state_dim, action_dim, target=False)
+        online = {key: value for key, value in ckp['model'].items() if key.startswith('online.')}
+        self.net.load_state_dict(online, assign=True)
+        self.net.eval()
+        self.action_dim = action_dim
+        self.exploration_rate = ckp.get('exploration_rate') if exploration_rate is None else exploration_rate
+        self.curr_step = 0
+
+    def act(self, state):
+        """Epsilon-greedy action for a single state, like Mario.act without the exploration decay"""
+        if np.random.rand() < self.exploration_rate:
+            action_idx = np.random.randint(self.action_dim)
+        else:
+            state = torch.as_tensor(np.asarray(state)).unsqueeze(0)
+            with torch.no_grad():
+                action_idx = torch.argmax(self.net(state, model='online'), axis=1).item()
+        self.curr_step += 1
+        return action_idx
+
+    def act_batch(self, states):
+        """Epsilon-greedy actions for N states with one forward pass, states of shape (N, *state_dim)"""
+        with torch.no_grad():
+            action_idx = torch.argmax(self.net(torch.as_tensor(np.asarray(states)), model='online'), axis=1).numpy()
+        explore = np.random.rand(len(action_idx)) < self.exploration_rate
+        action_idx[explore] = np.random.randint(self.action_dim, size=explore.sum())
+        self.curr_step += len(action_idx)
+        return action_idx
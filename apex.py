@@ -0,0 +1,236 @@
+import os
+os.environ['KMP_DUPLICATE_LIB_OK']='True'
+
+import datetime, queue, time
+import multiprocessing as mp
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import torch
+
+from agent import Mario
+from memory import ReplayBuffer
+from metrics import MetricLogger
+from neural import MarioNet
+from wrappers import make_env
+
+
+class SharedWeights:
+    '''Copy of `MarioNet.online` in shared memory that the learner publishes to actors
+
+    `version` is bumped on every publish so actors only copy new weights.
+    '''
+    def __init__(self, net):
+        self.params = [p.detach().clone().share_memory_() for p in net.state_dict().values()]
+        self.version = mp.Value('l', 0)
+        self.lock = mp.Lock()
+
+    def publish(self, net):
+        with self.lock:
+            for shared, p in zip(self.params, net.state_dict().values()):
+                shared.copy_(p)
+            self.version.value += 1
+
+    def pull(self, net, version):
+        """Copy the weights into `net` if they are newer than `version`, returns the current version"""
+        if self.version.value == version:
+            return version
+        with self.lock:
+            for p, shared in zip(net.state_dict().values(), self.params):
+                p.copy_(shared)
+            return self.version.value
+
+
+def actor_epsilon(index, num_actors, base=0.4, alpha=7):
+    """Ape-X per-actor exploration rate, from `base` down to base ** (1 + alpha)"""
+    if num_actors == 1:
+        return base
+    return base ** (1 + index / (num_actors - 1) * alpha)
+
+
+def run_actor(index, env_fn, state_dim, action_dim, weights, transitions, env_steps, epsilon, pull_every, chunk_size, stop):
+    """
+    Play with a local copy of MarioNet and push transitions to the learner.
+
+    Transitions are sent as uint8 in chunks of `chunk_size`, followed by an
+    ('episode', reward, length) record whenever an episode ends. The states
+    are copied out of the RingFrameStack ring, which overwrites them long
+    before the queue's feeder thread pickles a full chunk.
+    """
+    torch.set_num_threads(1)
+    env = env_fn()
+    net = MarioNet(state_dim, action_dim).float().online
+    version = weights.pull(net, -1)
+
+    state = np.array(ReplayBuffer.to_uint8(env.reset()))
+    chunk, ep_reward, ep_length, steps = [], 0.0, 0, 0
+    while not stop.is_set():
+        if np.random.rand() < epsilon:
+            action = np.random.randint(action_dim)
+        else:
+            with torch.no_grad():
+                action_values = net(torch.from_numpy(state).float().div_(255).unsqueeze(0))
+            action = torch.argmax(action_values, axis=1).item()
+
+        next_state, reward, done, info = env.step(action)
+        next_state = np.array(ReplayBuffer.to_uint8(next_state))
+        chunk.append((state, next_state, action, reward, done, info.get('frame_ids')))
+        ep_reward += reward
+        ep_length += 1
+        steps += 1
+        state = next_state
+
+        end = done or info['flag_get']
+        if len(chunk) == chunk_size or end:
+            transitions.put(('transitions', index, chunk))
+            with env_steps.get_lock():
+                env_steps.value += len(chunk)
+            chunk = []
+        if end:
+            transitions.put(('episode', index, (ep_reward, ep_length)))
+            state = np.array(ReplayBuffer.to_uint8(env.reset()))
+            ep_reward, ep_length = 0.0, 0
+
+        if steps % pull_every == 0:
+            version = weights.pull(net, version)
+    env.close()
+
+
+class ThroughputMeter:
+    '''Env steps/sec of the actors and updates/sec of the learner since the last report'''
+    def __init__(self, save_path):
+        self.save_path = save_path
+        with open(self.save_path, "w") as f:
+            f.write(f"{'EnvSteps':>12}{'Updates':>12}{'ActorSteps/s':>15}{'Updates/s':>15}{'Time':>20}\n")
+        self.last_time = time.time()
+        self.last_steps = 0
+        self.last_updates = 0
+
+    def report(self, steps, updates):
+        now = time.time()
+        elapsed = max(now - self.last_time, 1e-9)
+        steps_per_sec = (steps - self.last_steps) / elapsed
+        updates_per_sec = (updates - self.last_updates) / elapsed
+        self.last_time, self.last_steps, self.last_updates = now, steps, updates
+
+        print(
+            f"Env steps {steps} - "
+            f"Updates {updates} - "
+            f"Actors {steps_per_sec:.1f} steps/s - "
+            f"Learner {updates_per_sec:.1f} updates/s"
+        )
+        with open(self.save_path, "a") as f:
+            f.write(
+                f"{steps:12d}{updates:12d}{steps_per_sec:15.3f}{updates_per_sec:15.3f}"
+                f"{datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S'):>20}\n"
+            )
+
+
+def run_learner(mario, logger, meter, weights, transitions, env_steps, total_steps, publish_every, target_sync_every, report_every, stop):
+    """
+    Ingest actor transitions into mario.memory and run mario.update() continuously
+
+    Each round ingests at most updates_per_learn * batch_size transitions before
+    running updates_per_learn updates, so actors producing faster than the
+    learner ingests fill the bounded queue and wait, rather than starving it.
+    """
+    updates, episodes, ingested_steps, q, loss = 0, 0, 0, None, None
+    drain_limit = mario.updates_per_learn * mario.batch_size
+    last_report = time.time()
+    while env_steps.value < total_steps:
+        # Drain what the actors produced, block only while the learner has nothing to do
+        learning = len(mario.memory) >= mario.burnin
+        ingested = 0
+        try:
+            kind, index, data = transitions.get(block=not learning, timeout=1)
+            while True:
+                if kind == 'transitions':
+                    ingested += len(data)
+                    for state, next_state, action, reward, done, frame_ids in data:
+                        mario.cache(state, next_state, action, reward, done, env=index, frame_ids=frame_ids)
+                        ingested_steps += 1
+                        logger.log_step(reward, loss, q, ingested_steps, env=index)
+                else:
+                    logger.log_episode(env=index)
+                    logger.record(episode=episodes, epsilon=mario.exploration_rate, step=mario.curr_step)
+                    episodes += 1
+                if ingested >= drain_limit:
+                    break
+                kind, index, data = transitions.get_nowait()
+        except queue.Empty:
+            pass
+
+        # learn() is not used here, its schedules are driven by the ingested env steps
+        last_step, mario.curr_step = mario.curr_step, env_steps.value
+        if mario.curr_step // mario.save_every > last_step // mario.save_every:
+            mario.save()
+
+        if len(mario.memory) >= max(mario.burnin, mario.batch_size):
+            for _ in range(mario.updates_per_learn):
+                q, loss = mario.update()
+                updates += 1
+                if updates % publish_every == 0:
+                    weights.publish(mario.net.online)
+                if updates % target_sync_every == 0:
+                    mario.sync_Q_target()
+
+        if time.time() - last_report >= report_every:
+            meter.report(env_steps.value, updates)
+            last_report = time.time()
+    stop.set()
+
+
+if __name__ == '__main__':
+    stage = 'SuperMarioBros-1-1-v0'
+    num_actors = 4
+    total_steps = int(1e7) # env steps summed over actors
+    publish_every = 100 # no. of learner updates between weight publications
+    pull_every = 400 # no. of actor steps between checks for new weights
+    target_sync_every = 2500 # no. of learner updates between Q_target & Q_online sync
+    chunk_size = 64 # no. of transitions sent to the learner at once
+    report_every = 30 # seconds between throughput reports
+
+    save_dir = Path('checkpoints') / datetime.datetime.now().strftime('%Y-%m-%dT%H-%M-%S')
+    save_dir.mkdir(parents=True)
+
+    env_fn = partial(make_env, stage)
+    probe = env_fn()
+    action_dim = probe.action_space.n
+    probe.close()
+
+    checkpoint = None # Path('checkpoints/2020-10-21T18-25-27/mario.chkpt')
+    mario = Mario(state_dim=(4, 84, 84), action_dim=action_dim, save_dir=save_dir, checkpoint=checkpoint, prioritized=True)
+    # the actors explore with their own fixed epsilon
+    mario.exploration_rate = 0
+
+    ctx = mp.get_context('fork')
+    weights = SharedWeights(mario.net.online)
+    transitions = ctx.Queue(maxsize=1024)
+    env_steps = ctx.Value('l', 0)
+    stop = ctx.Event()
+
+    actors = [
+        ctx.Process(
+            target=run_actor,
+            args=(i, env_fn, mario.state_dim, action_dim, weights, transitions, env_steps,
+                  actor_epsilon(i, num_actors), pull_every, chunk_size, stop),
+            daemon=True,
+        )
+        for i in range(num_actors)
+    ]
+    for actor in actors:
+        actor.start()
+
+    logger = MetricLogger(save_dir, num_envs=num_actors)
+    meter = ThroughputMeter(save_dir / "throughput")
+    try:
+        run_learner(mario, logger, meter, weights, transitions, env_steps, total_steps,
+                    publish_every, target_sync_every, report_every, stop)
+    finally:
+        stop.set()
+        for actor in actors:
+            actor.join(timeout=5)
+        mario.save()
+        mario.checkpoints.close()
+        logger.close()
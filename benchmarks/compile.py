@@ -0,0 +1,67 @@
+"""
+MarioNet forward and training step time per batch size, eager vs compiled modes
+
+    python -m benchmarks.compile
+"""
+import sys, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import torch
+
+from neural import MarioNet
+
+MODES = (None, 'trace', 'script', 'compile')
+BATCH_SIZES = (1, 32, 256)
+
+
+def forward_time(net, states, repeat):
+    with torch.no_grad():
+        start = time.perf_counter()
+        for _ in range(repeat):
+            net(states, model='online')
+            net(states, model='target')
+    return (time.perf_counter() - start) / repeat
+
+
+def train_step_time(net, optimizer, states, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        q = net(states, model='online').max(dim=1).values
+        with torch.no_grad():
+            target = net(states, model='target').max(dim=1).values
+        loss = torch.nn.functional.smooth_l1_loss(q, target)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    return (time.perf_counter() - start) / repeat
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    channels_last = '--channels-last' in sys.argv
+    repeat = 20
+
+    print(f"{'mode':>8}{'batch':>7}{'forward ms':>12}{'train ms':>12}{'speedup':>10}")
+    eager = {}
+    for mode in MODES:
+        net = MarioNet((4, 84, 84), 2).to(device)
+        if mode:
+            net.compile_heads(mode, torch.zeros((1, 4, 84, 84), device=device), channels_last=channels_last)
+            if net.compile_mode is None:
+                print(f"{mode:>8}: unavailable, skipped")
+                continue
+        optimizer = torch.optim.Adam(net.parameters(), lr=0.00025)
+        for batch_size in BATCH_SIZES:
+            states = torch.randint(0, 256, (batch_size, 4, 84, 84), dtype=torch.uint8, device=device)
+            # warm up, torch.compile recompiles on the first new batch size
+            forward_time(net, states, 2)
+            train_step_time(net, optimizer, states, 2)
+            forward = forward_time(net, states, repeat)
+            train = train_step_time(net, optimizer, states, repeat)
+            if mode is None:
+                eager[batch_size] = forward
+            print(f"{mode or 'eager':>8}{batch_size:7d}{forward * 1e3:12.3f}{train * 1e3:12.3f}"
+                  f"{eager[batch_size] / forward:9.2f}x")
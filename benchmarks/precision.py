@@ -0,0 +1,62 @@
+"""
+Updates/sec and loss curve of Mario.update, fp32 vs bf16 autocast
+
+    python -m benchmarks.precision
+
+Both runs start from the same weights and replay the same transitions, built
+from the stand-in env frames, so their loss curves can be compared directly.
+"""
+import sys, tempfile, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+import torch
+
+from agent import Mario
+from benchmarks.standin import StandInMarioEnv
+from wrappers import PreprocessObservation
+
+
+def fill(mario, frames, num_transitions, seed=0):
+    rng = np.random.default_rng(seed)
+    stack = mario.state_dim[0]
+    for t in range(num_transitions):
+        i = t % (len(frames) - stack)
+        state, next_state = frames[i:i + stack], frames[i + 1:i + stack + 1]
+        mario.cache(state, next_state, rng.integers(mario.action_dim), rng.normal(), t % 400 == 399)
+
+
+def run(precision, frames, init, num_updates, report_every):
+    torch.manual_seed(0)
+    with tempfile.TemporaryDirectory() as save_dir:
+        mario = Mario((4, 84, 84), 2, Path(save_dir), prefetch=False, precision=precision)
+        mario.net.load_state_dict(init)
+        mario.memory.rng = np.random.default_rng(0)
+        fill(mario, frames, 5000)
+        mario.update()  # warm up
+
+        losses = []
+        start = time.perf_counter()
+        for _ in range(num_updates):
+            losses.append(mario.update()[1])
+        elapsed = time.perf_counter() - start
+    curve = [np.mean(losses[i:i + report_every]) for i in range(0, num_updates, report_every)]
+    return num_updates / elapsed, curve
+
+
+if __name__ == '__main__':
+    env = StandInMarioEnv()
+    preprocess = PreprocessObservation(env, shape=84)
+    frames = np.stack([preprocess.observation(frame).copy() for frame in env.frames])
+    init = Mario((4, 84, 84), 2, Path(tempfile.gettempdir()), prefetch=False).net.state_dict()
+    num_updates, report_every = 200, 20
+
+    results = {precision: run(precision, frames, init, num_updates, report_every) for precision in ('fp32', 'bf16')}
+    for precision, (updates_per_sec, _) in results.items():
+        print(f"{precision:>6}: {updates_per_sec:8.2f} updates/sec")
+    print(f"{'speedup':>6}: {results['bf16'][0] / results['fp32'][0]:8.2f}x")
+    print(f"{'updates':>8}{'fp32 loss':>12}{'bf16 loss':>12}")
+    for i, (fp32, bf16) in enumerate(zip(results['fp32'][1], results['bf16'][1])):
+        print(f"{(i + 1) * report_every:8d}{fp32:12.5f}{bf16:12.5f}")
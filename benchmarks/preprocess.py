@@ -0,0 +1,49 @@
+"""
+Frames/sec of the observation preprocessing, current wrapper chain vs PreprocessObservation
+
+    python -m benchmarks.preprocess
+"""
+import sys, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from gym.wrappers import GrayScaleObservation, TransformObservation
+
+from benchmarks.standin import StandInMarioEnv
+from wrappers import PreprocessObservation, ResizeObservation
+
+
+def chain_wrappers(env):
+    env = GrayScaleObservation(env, keep_dim=False)
+    env = ResizeObservation(env, shape=84)
+    env = TransformObservation(env, f=lambda x: x / 255.)
+    return [env.env.env, env.env, env]
+
+
+def fused_wrappers(env):
+    return [PreprocessObservation(env, shape=84)]
+
+
+def frames_per_sec(wrappers, frames, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for frame in frames:
+            obs = frame
+            for wrapper in wrappers:
+                obs = wrapper.observation(obs)
+    return repeat * len(frames) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    env = StandInMarioEnv()
+    frames = env.frames
+    repeat = 20
+
+    results = {}
+    for name, build in (('chain', chain_wrappers), ('fused', fused_wrappers)):
+        wrappers = build(env)
+        frames_per_sec(wrappers, frames[:4], 1)  # warm up
+        results[name] = frames_per_sec(wrappers, frames, repeat)
+        print(f"{name:>8}: {results[name]:10.1f} frames/sec")
+    print(f"{'speedup':>8}: {results['fused'] / results['chain']:10.2f}x")
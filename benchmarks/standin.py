@@ -0,0 +1,34 @@
+import gym
+import numpy as np
+from gym.spaces import Box, Discrete
+
+
+class StandInMarioEnv(gym.Env):
+    '''Deterministic stand-in for the Super Mario Bros env, runs without the ROM or a display
+
+    Emits 240x256 RGB frames cycled from a fixed random bank, a constant reward and
+    the `x_pos`/`flag_get` info keys the main loop reads, with the old 4-tuple step API.
+    '''
+    def __init__(self, num_actions=2, episode_length=400, num_frames=64, seed=0):
+        self.observation_space = Box(low=0, high=255, shape=(240, 256, 3), dtype=np.uint8)
+        self.action_space = Discrete(num_actions)
+        self.episode_length = episode_length
+        rng = np.random.default_rng(seed)
+        self.frames = rng.integers(0, 256, size=(num_frames, 240, 256, 3), dtype=np.uint8)
+        self.t = 0
+        self.episode = 0
+
+    def reset(self, **kwargs):
+        self.t = 0
+        self.episode += 1
+        return self.frames[self.episode % len(self.frames)]
+
+    def step(self, action):
+        self.t += 1
+        obs = self.frames[(self.episode + self.t) % len(self.frames)]
+        done = self.t >= self.episode_length
+        info = dict(x_pos=40 + self.t, flag_get=False)
+        return obs, 1.0, done, info
+
+    def render(self, mode='human'):
+        return self.frames[(self.episode + self.t) % len(self.frames)]
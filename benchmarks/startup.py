@@ -0,0 +1,48 @@
+"""
+Time from checkpoint to first action, Mario(checkpoint=...) vs MarioPolicy
+
+    python -m benchmarks.startup
+"""
+import sys, tempfile, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+
+from agent import Mario, MarioPolicy
+
+
+def first_action_time(build, state, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        agent = build()
+        agent.act(state)
+        times.append(time.perf_counter() - start)
+        if isinstance(agent, Mario):
+            agent.sampler.close()
+            agent.checkpoints.close()
+    return np.median(times)
+
+
+if __name__ == '__main__':
+    state_dim, action_dim = (4, 84, 84), 2
+    state = np.zeros(state_dim, dtype=np.uint8)
+    repeat = 5
+
+    with tempfile.TemporaryDirectory() as save_dir:
+        save_dir = Path(save_dir)
+        mario = Mario(state_dim, action_dim, save_dir)
+        mario.save()
+        mario.checkpoints.close()
+        checkpoint = next(save_dir.glob('mario_net_*.chkpt'))
+        print(f"checkpoint: {checkpoint.stat().st_size / 2 ** 20:.1f} MB")
+
+        results = {
+            'Mario': first_action_time(lambda: Mario(state_dim, action_dim, save_dir, checkpoint=checkpoint), state, repeat),
+            'MarioPolicy': first_action_time(lambda: MarioPolicy(checkpoint, state_dim, action_dim, exploration_rate=0), state, repeat),
+        }
+    for name, seconds in results.items():
+        print(f"{name:>12}: {seconds * 1e3:8.1f} ms to first action")
+    print(f"{'speedup':>12}: {results['Mario'] / results['MarioPolicy']:8.2f}x")
@@ -0,0 +1,154 @@
+"""
+End-to-end benchmark of the training pipeline on the stand-in env, no ROM or display needed
+
+    python -m benchmarks.suite [--out results.json] [--baseline benchmarks/baseline.json] [--save-baseline]
+
+Measures env steps/sec through the make_env wrapper chain, Mario.act latency
+at batch 1, cache throughput, recall latency, updates/sec and checkpoint
+save/load time. Results are written to JSON; with a baseline, every metric
+is compared and the run fails if one is more than `--tolerance` worse.
+Metrics ending in _per_sec are better higher, the _ms ones lower.
+"""
+import argparse, json, platform, sys, tempfile, time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import numpy as np
+import torch
+
+from agent import Mario
+from benchmarks.standin import StandInMarioEnv
+from wrappers import PreprocessObservation, RingFrameStack, SkipFrame
+
+BASELINE = Path(__file__).resolve().parent / 'baseline.json'
+
+
+def make_standin_env(seed=0):
+    """The make_env chain after JoypadSpace, on the stand-in env"""
+    env = StandInMarioEnv(seed=seed)
+    env = SkipFrame(env, skip=4)
+    env = PreprocessObservation(env, shape=84)
+    env = RingFrameStack(env, num_stack=4)
+    return env
+
+
+def median_ms(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return float(np.median(times) * 1e3)
+
+
+def env_steps(env, num_steps, rng):
+    """Play random actions, returns the transitions (state, next_state, action, reward, done, frame_ids)"""
+    transitions = []
+    state = env.reset()
+    for _ in range(num_steps):
+        action = int(rng.integers(env.action_space.n))
+        next_state, reward, done, info = env.step(action)
+        transitions.append((state, next_state, action, reward, done, info['frame_ids']))
+        state = env.reset() if done else next_state
+    return transitions
+
+
+def run(save_dir, seed=0):
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    rng = np.random.default_rng(seed)
+    results = {}
+
+    env = make_standin_env(seed)
+    start = time.perf_counter()
+    env_steps(env, 1000, rng)
+    results['env_steps_per_sec'] = 1000 / (time.perf_counter() - start)
+
+    mario = Mario((4, 84, 84), env.action_space.n, save_dir, prefetch=False)
+    mario.memory.rng = np.random.default_rng(seed)
+    mario.burnin = 0
+
+    # the frames are views into the ring, copy them so they outlive it
+    transitions = [(np.array(s), np.array(n), a, r, d, ids) for s, n, a, r, d, ids in env_steps(env, 2000, rng)]
+    start = time.perf_counter()
+    for state, next_state, action, reward, done, frame_ids in transitions:
+        mario.cache(state, next_state, action, reward, done, frame_ids=frame_ids)
+    results['cache_per_sec'] = len(transitions) / (time.perf_counter() - start)
+
+    state = transitions[0][0]
+    mario.exploration_rate = 0
+    mario.exploration_rate_min = 0
+    results['act_ms'] = median_ms(lambda: mario.act(state), 200)
+    results['recall_ms'] = median_ms(mario.recall, 200)
+
+    mario.update()  # warm up
+    start = time.perf_counter()
+    for _ in range(30):
+        mario.update()
+    results['learn_updates_per_sec'] = 30 / (time.perf_counter() - start)
+
+    def save():
+        mario.save()
+        mario.checkpoints.wait()
+    results['save_ms'] = median_ms(save, 10)
+    checkpoint = next(Path(save_dir).glob('mario_net_*.chkpt'))
+    results['load_ms'] = median_ms(lambda: mario.load(checkpoint), 10)
+    mario.checkpoints.close()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print each metric against the baseline, returns the names of the regressed ones"""
+    regressions = []
+    print(f"{'metric':>24}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, value in results.items():
+        if name not in baseline:
+            print(f"{name:>24}{'-':>12}{value:12.3f}")
+            continue
+        ratio = value / baseline[name] if baseline[name] else float('inf')
+        # > 1 is better
+        gain = ratio if name.endswith('_per_sec') else 1 / ratio
+        flag = '  REGRESSION' if gain < 1 - tolerance else ''
+        print(f"{name:>24}{baseline[name]:12.3f}{value:12.3f}{gain - 1:+10.1%}{flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--out', type=Path, default=Path('benchmark_results.json'))
+    parser.add_argument('--baseline', type=Path, default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help="store these results as the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="allowed slowdown before failing")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as save_dir:
+        results = run(Path(save_dir))
+    report = dict(
+        results=results,
+        python=platform.python_version(),
+        torch=torch.__version__,
+        numpy=np.__version__,
+        machine=platform.machine(),
+        processor=platform.processor(),
+        threads=torch.get_num_threads(),
+        time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+    )
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.out}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif args.baseline.exists():
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+    else:
+        for name, value in results.items():
+            print(f"{name:>24}{value:12.3f}")
@@ -0,0 +1,94 @@
+import atexit, os, queue, re, threading
+from pathlib import Path
+
+import torch
+
+
+def snapshot(state):
+    """Copy of a nested dict/list of tensors with every tensor cloned to CPU"""
+    if isinstance(state, torch.Tensor):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+class CheckpointWriter:
+    '''Write checkpoints from a background thread so saving does not block training
+
+    `write()` only clones the state to CPU, the thread then serializes it to a
+    temporary file that is renamed over the target, so a checkpoint on disk is
+    always complete, and runs the optional `after` callable of the write. After each write the `mario_net_N.chkpt` files of
+    `save_dir` are pruned to the `keep_last` newest, plus every N multiple of
+    `keep_every`; with both None every checkpoint is kept.
+    '''
+    def __init__(self, save_dir, keep_last=None, keep_every=None):
+        self.save_dir = Path(save_dir)
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        # at most one checkpoint waits while another is written
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, state, path, after=None):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((snapshot(state), Path(path), after))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                state, path, after = item
+                tmp_path = path.with_name(path.name + '.tmp')
+                torch.save(state, tmp_path)
+                os.replace(tmp_path, path)
+                print(f"MarioNet saved to {path} at step {state.get('curr_step')}")
+                self.prune()
+                if after is not None:
+                    after()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def checkpoints(self):
+        """(N, path) of the mario_net_N.chkpt files in save_dir, oldest first"""
+        found = []
+        for path in self.save_dir.glob('mario_net_*.chkpt'):
+            match = re.fullmatch(r'mario_net_(\d+)\.chkpt', path.name)
+            if match:
+                found.append((int(match.group(1)), path))
+        return sorted(found)
+
+    def prune(self):
+        if self.keep_last is None and self.keep_every is None:
+            return
+        found = self.checkpoints()
+        keep = set(n for n, _ in found[-self.keep_last:]) if self.keep_last else set()
+        if self.keep_every:
+            keep.update(n for n, _ in found if n % self.keep_every == 0)
+        for n, path in found:
+            if n not in keep:
+                path.unlink(missing_ok=True)
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk"""
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        if not self.thread.is_alive():
+            return
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
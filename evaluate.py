@@ -0,0 +1,147 @@
+"""
+Headless evaluation of a checkpoint over one or more stages, in parallel
+
+    python evaluate.py checkpoints/2025-06-30T08-55-23/mario_net_4.chkpt \
+        --stages SuperMarioBros-1-1-v0 SuperMarioBros-1-2-v0 --episodes 10 --workers 8
+
+The envs run in SubprocVecEnv workers, without rendering, and all of them act
+from one forward pass of the online network per step (one per checkpoint with
+`evaluate_many`). Nothing is cached. Each stage plays `episodes` episodes; the
+envs of a stage are assigned round-robin, and only episodes started before the
+stage's quota was reached are counted, so long episodes are not
+under-represented.
+"""
+import os
+os.environ['KMP_DUPLICATE_LIB_OK']='True'
+
+import argparse, json, time
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+
+from agent import MarioPolicy
+from vector import SubprocVecEnv
+from wrappers import make_env
+
+
+def evaluate(checkpoint, stages=('SuperMarioBros-1-1-v0',), episodes=10, num_workers=8, exploration_rate=0.05):
+    """
+    Inputs:
+    checkpoint (Path): mario_net_N.chkpt
+    stages (list of str): gym_super_mario_bros env ids
+    episodes (int): no. of episodes per stage
+    num_workers (int): no. of env processes, shared by the stages
+    exploration_rate (float): epsilon of the policy; the emulator is deterministic, with 0 every episode of a stage is the same
+    Outputs:
+    results (dict): 'episodes' (list of dict per episode), 'stages' (summary per stage), 'steps_per_sec'
+    """
+    return evaluate_many([checkpoint], stages, episodes, num_workers, exploration_rate)[0]
+
+
+def evaluate_many(checkpoints, stages=('SuperMarioBros-1-1-v0',), episodes=10, num_workers=8, exploration_rate=0.05):
+    """
+    Evaluate several checkpoints at once, the envs being shared by every (checkpoint, stage)
+
+    Each step runs one forward pass per checkpoint over the envs assigned to it.
+
+    Outputs:
+    results (list of dict): the results of `evaluate` for each checkpoint, with a shared 'steps_per_sec'
+    """
+    runs = [(c, stage) for c in range(len(checkpoints)) for stage in stages]
+    num_workers = max(num_workers, len(runs))
+    env_runs = [runs[i % len(runs)] for i in range(num_workers)]
+    env = SubprocVecEnv([partial(make_env, stage) for _, stage in env_runs])
+    policies = [
+        MarioPolicy(checkpoint, state_dim=env.obs_shape, action_dim=env.action_space.n, exploration_rate=exploration_rate)
+        for checkpoint in checkpoints
+    ]
+    groups = [np.array([i for i, (c, _) in enumerate(env_runs) if c == run]) for run in range(len(checkpoints))]
+
+    started = {run: 0 for run in runs}
+    counted = np.zeros(num_workers, dtype=bool)
+    ep_reward = np.zeros(num_workers)
+    ep_steps = np.zeros(num_workers, dtype=np.int64)
+    rows = [[] for _ in checkpoints]
+
+    def start_episode(i):
+        run = env_runs[i]
+        counted[i] = started[run] < episodes
+        started[run] += counted[i]
+        ep_reward[i], ep_steps[i] = 0.0, 0
+
+    states = env.reset()
+    for i in range(num_workers):
+        start_episode(i)
+
+    steps, start = 0, time.perf_counter()
+    actions = np.empty(num_workers, dtype=np.int64)
+    try:
+        while sum(map(len, rows)) < episodes * len(runs):
+            for policy, group in zip(policies, groups):
+                actions[group] = policy.act_batch(states[group])
+            states, rewards, dones, infos = env.step(actions)
+            steps += num_workers
+            ep_reward += rewards
+            ep_steps += 1
+            for i, info in enumerate(infos):
+                if 'terminal_observation' not in info:
+                    continue
+                if counted[i]:
+                    c, stage = env_runs[i]
+                    rows[c].append(dict(
+                        stage=stage, env=i, reward=float(ep_reward[i]), steps=int(ep_steps[i]),
+                        x_pos=int(info['x_pos']), flag_get=bool(info['flag_get'])
+                    ))
+                start_episode(i)
+    finally:
+        env.close()
+    steps_per_sec = steps / (time.perf_counter() - start)
+
+    results = []
+    for played_by_checkpoint in rows:
+        summary = {}
+        for stage in stages:
+            played = [row for row in played_by_checkpoint if row['stage'] == stage]
+            summary[stage] = dict(
+                episodes=len(played),
+                mean_reward=float(np.mean([row['reward'] for row in played])),
+                mean_x_pos=float(np.mean([row['x_pos'] for row in played])),
+                max_x_pos=int(np.max([row['x_pos'] for row in played])),
+                clear_rate=float(np.mean([row['flag_get'] for row in played])),
+            )
+        results.append(dict(episodes=played_by_checkpoint, stages=summary, steps_per_sec=steps_per_sec))
+    return results
+
+
+def print_results(results):
+    print(f"{'Stage':>24}{'Episodes':>10}{'MeanReward':>12}{'MeanXPos':>10}{'MaxXPos':>10}{'Clear':>8}")
+    for stage, row in results['stages'].items():
+        print(
+            f"{stage:>24}{row['episodes']:10d}{row['mean_reward']:12.1f}"
+            f"{row['mean_x_pos']:10.1f}{row['max_x_pos']:10d}{row['clear_rate']:8.0%}"
+        )
+    print(f"{results['steps_per_sec']:.1f} env steps/sec")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Evaluate a checkpoint without rendering, in parallel")
+    parser.add_argument('checkpoint', type=Path)
+    parser.add_argument('--stages', nargs='+', default=['SuperMarioBros-1-1-v0'])
+    parser.add_argument('--episodes', type=int, default=10, help="per stage")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    # the emulator is deterministic, a greedy policy would play the same episode every time
+    parser.add_argument('--epsilon', type=float, default=0.05)
+    parser.add_argument('--out', type=Path, help="also write the per-episode results as JSON")
+    args = parser.parse_args()
+
+    results = evaluate(args.checkpoint, args.stages, args.episodes, args.workers, args.epsilon)
+    for row in results['episodes']:
+        print(
+            f"{row['stage']} env {row['env']} - Reward {row['reward']:.1f} - "
+            f"Steps {row['steps']} - x_pos {row['x_pos']} - flag_get {row['flag_get']}"
+        )
+    print_results(results)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
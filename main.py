@@ -2,35 +2,26 @@ import os
 os.environ['KMP_DUPLICATE_LIB_OK']='True'
 
 import random, datetime
+from functools import partial
 from pathlib import Path
 
-import gym
-import gym_super_mario_bros
-from gym.wrappers import FrameStack, GrayScaleObservation, TransformObservation
-from nes_py.wrappers import JoypadSpace
-
 from metrics import MetricLogger
+from profiler import Profiler
 from agent import Mario
-from wrappers import ResizeObservation, SkipFrame
-
-# Initialize Super Mario environment
-env = gym_super_mario_bros.make('SuperMarioBros-1-1-v0')
-
-# Limit the action-space to
-#   0. walk right
-#   1. jump right
-env = JoypadSpace(
-    env,
-    [['right'],
-    ['right', 'A']]
-)
+from vector import SubprocVecEnv
+from wrappers import make_env
 
-# Apply Wrappers to environment
-env = SkipFrame(env, skip=4)
-env = GrayScaleObservation(env, keep_dim=False)
-env = ResizeObservation(env, shape=84)
-env = TransformObservation(env, f=lambda x: x / 255.)
-env = FrameStack(env, num_stack=4)
+stage = 'SuperMarioBros-1-1-v0'
+num_envs = 1 # > 1 runs the envs in worker processes and acts on all of them with one forward pass
+checkpoints = None # e.g. [600, 1200, 1800, 2400], x_pos of savestates captured on the way through the level, with random_start
+random_start = False # start episodes at a random captured savestate instead of the level start
+
+# Initialize Super Mario environment, see wrappers.make_env for the action-space and wrappers
+env_fn = partial(make_env, stage, checkpoints=checkpoints, random_start=random_start)
+if num_envs > 1:
+    env = SubprocVecEnv([env_fn] * num_envs)
+else:
+    env = env_fn()
 
 env.reset()
 
@@ -38,50 +29,121 @@ save_dir = Path('checkpoints') / datetime.datetime.now().strftime('%Y-%m-%dT%H-%
 save_dir.mkdir(parents=True)
 
 checkpoint = None # Path('checkpoints/2020-10-21T18-25-27/mario.chkpt')
-mario = Mario(state_dim=(4, 84, 84), action_dim=env.action_space.n, save_dir=save_dir, checkpoint=checkpoint)
+replay_dir = None # save_dir / 'replay' to keep the replay buffer on disk
+prioritized = False # sample the replay buffer by TD error
+n_step = 1 # no. of steps summed into each TD target
+save_replay = False # snapshot the replay buffer with each checkpoint, restored by `checkpoint` to skip burn-in
+compile_mode = None # 'trace', 'script' or 'compile' to run MarioNet compiled, see benchmarks/compile.py
+channels_last = False # keep the compiled MarioNet's weights and inputs in NHWC, only used with compile_mode
+precision = 'fp32' # 'bf16' for mixed-precision learn steps on CPUs/GPUs with bf16 units, see benchmarks/precision.py
+# Replay ratio: batch_size * updates_per_learn transitions are sampled every learn_every steps
+batch_size = 32 # larger batches keep more BLAS threads busy on CPU
+updates_per_learn = 1 # no. of gradient updates each time Mario learns
+replay_ratio = None # e.g. 8, sampled transitions per env step, sets learn_every from batch_size and updates_per_learn
+lr_scaling = None # 'linear' or 'sqrt', scales the learning rate with batch_size / 32
+schedule_on = 'env_steps' # 'updates' to count sync_every and save_every in gradient updates
+keep_last = None # e.g. 5, no. of newest checkpoints kept in save_dir
+keep_every = None # e.g. 10, also keep mario_net_N.chkpt when N is a multiple of it
+profile = False # time each phase of the loop, p50/p99 written to save_dir/profile every minute
+profiler = Profiler(save_dir / 'profile', enabled=profile)
+if num_envs == 1:
+    # times env.step of each wrapper, the workers of SubprocVecEnv are timed as a whole
+    profiler.profile_env(env)
+mario = Mario(
+    state_dim=(4, 84, 84), action_dim=env.action_space.n, save_dir=save_dir, checkpoint=checkpoint,
+    replay_dir=replay_dir, prioritized=prioritized, n_step=n_step, save_replay=save_replay,
+    compile_mode=compile_mode, channels_last=channels_last, precision=precision,
+    batch_size=batch_size, updates_per_learn=updates_per_learn, replay_ratio=replay_ratio,
+    lr_scaling=lr_scaling, schedule_on=schedule_on, keep_last=keep_last, keep_every=keep_every,
+    profiler=profiler
+)
 
-logger = MetricLogger(save_dir)
+logger = MetricLogger(save_dir, num_envs=num_envs)
 
 episodes = 10
 
+def record(e):
+    if e % 1 == 0:
+        with profiler.phase('logging'):
+            logger.record(
+                episode=e,
+                epsilon=mario.exploration_rate,
+                step=mario.curr_step
+            )
+    profiler.report(mario.curr_step, mario.memory)
+
 ### for Loop that train the model num_episodes times by playing the game
-for e in range(episodes):
+if num_envs == 1:
+    for e in range(episodes):
 
-    state = env.reset()
+        state = env.reset()
 
-    # Play the game!
-    while True:
+        # Play the game!
+        while True:
 
-        # 3. Show environment (the visual) [WIP]
-        # env.render()
+            # 3. Show environment (the visual) [WIP]
+            # env.render()
 
-        # 4. Run agent on the state
-        action = mario.act(state)
+            # 4. Run agent on the state
+            with profiler.phase('act'):
+                action = mario.act(state)
 
-        # 5. Agent performs action
-        next_state, reward, done, info = env.step(action)
+            # 5. Agent performs action
+            next_state, reward, done, info = env.step(action)
 
-        # 6. Remember
-        mario.cache(state, next_state, action, reward, done)
+            # 6. Remember
+            with profiler.phase('cache'):
+                mario.cache(state, next_state, action, reward, done, frame_ids=info.get('frame_ids'))
 
-        # 7. Learn
-        q, loss = mario.learn()
+            # 7. Learn
+            with profiler.phase('learn'):
+                q, loss = mario.learn()
 
-        # 8. Logging
-        logger.log_step(reward, loss, q)
+            # 8. Logging
+            with profiler.phase('logging'):
+                logger.log_step(reward, loss, q, mario.curr_step)
 
-        # 9. Update state
-        state = next_state
+            # 9. Update state
+            state = next_state
 
-        # 10. Check if end of game
-        if done or info['flag_get']:
-            break
+            # 10. Check if end of game
+            if done or info['flag_get']:
+                break
 
-    logger.log_episode()
+        logger.log_episode()
+        record(e)
 
-    if e % 1 == 0:
-        logger.record(
-            episode=e,
-            epsilon=mario.exploration_rate,
-            step=mario.curr_step
-        )
+### Vectorized loop, finished envs are reset by SubprocVecEnv
+else:
+    e = 0
+    states = env.reset()
+    while e < episodes:
+        with profiler.phase('act'):
+            actions = mario.act_batch(states)
+        with profiler.phase('env.step'):
+            next_states, rewards, dones, infos = env.step(actions)
+
+        with profiler.phase('cache'):
+            for i in range(num_envs):
+                next_state = infos[i].get('terminal_observation', next_states[i])
+                mario.cache(states[i], next_state, actions[i], rewards[i], dones[i], env=i, frame_ids=infos[i].get('frame_ids'))
+
+        with profiler.phase('learn'):
+            q, loss = mario.learn()
+
+        for i in range(num_envs):
+            logger.log_step(rewards[i], loss, q, mario.curr_step, env=i)
+            if 'terminal_observation' in infos[i]:
+                logger.log_episode(env=i)
+                record(e)
+                e += 1
+
+        states = next_states
+
+    env.close()
+
+profiler.report(mario.curr_step, mario.memory, force=True)
+# wait for the checkpoints and plots still being written, the writer also flushes the replay buffer
+mario.checkpoints.close()
+mario.memory.flush()
+logger.close()
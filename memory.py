@@ -0,0 +1,571 @@
+import json
+import queue
+import shutil
+import threading
+import numpy as np
+import torch
+from collections import deque
+from pathlib import Path
+
+
+class ReplayBuffer:
+    '''Replay memory storing every 84x84 frame once as uint8
+
+    Transitions only keep the indices of their frames in a shared frame ring,
+    `state` and `next_state` stacks are rebuilt with one gather at sample time.
+    A state that continues the previous `next_state` reuses its frames, so a
+    step normally costs a single new frame.
+
+    With `storage_dir` the arrays are `np.memmap` files in that directory, so
+    the capacity is bounded by disk rather than RAM. An existing buffer in
+    `storage_dir` is reopened in place, see `flush()`.
+
+    With `n_step` > 1 a transition holds the discounted return of the next
+    `n_step` rewards and the state `n_step` steps later, the learner then
+    bootstraps with `gamma ** n_step`.
+    '''
+    def __init__(self, capacity, state_dim, storage_dir=None, n_step=1, gamma=0.9):
+        self.capacity = int(capacity)
+        self.stack, h, w = state_dim
+        self.storage_dir = Path(storage_dir) if storage_dir is not None else None
+        reopen = self.storage_dir is not None and (self.storage_dir / "meta.json").exists()
+        if self.storage_dir is not None:
+            self.storage_dir.mkdir(parents=True, exist_ok=True)
+
+        # Each new episode may cost `stack` extra frames, the slack keeps the
+        # buffer close to `capacity` transitions when episodes are short and
+        # covers the frames of streams that lag behind the oldest transition.
+        self.frame_capacity = self.capacity + self.capacity // 10 + 2 * self.stack
+        self.frames = self._allocate("frames", (self.frame_capacity, h, w), np.uint8, reopen)
+
+        # Absolute frame numbers (not ring positions) of each transition
+        self.state_idx = self._allocate("state_idx", (self.capacity, self.stack), np.int64, reopen)
+        self.next_idx = self._allocate("next_idx", (self.capacity, self.stack), np.int64, reopen)
+        self.action = self._allocate("action", (self.capacity,), np.int64, reopen)
+        self.reward = self._allocate("reward", (self.capacity,), np.float32, reopen)
+        self.done = self._allocate("done", (self.capacity,), np.bool_, reopen)
+
+        self.frame_count = 0  # no. of frames ever written
+        self.count = 0  # no. of transitions ever written
+        self.tail = 0  # oldest transition whose frames are still stored
+
+        # Frames of the last `next_state` of each stream (env), used to chain
+        # consecutive steps when transitions of several envs are interleaved.
+        # With frame ids, the ids of that `next_state` and the positions by id.
+        self._last_idx = {}
+        self._last_ids = {}
+
+        # Steps of the current episode of each stream still waiting for their n-step
+        # return, as [state_idx, action, return so far, discount of the next reward]
+        self.n_step = n_step
+        self.gamma = gamma
+        self._pending = {}
+
+        self.rng = np.random.default_rng()
+        # held while writing so a BatchSampler thread never reads a half-written transition
+        self.lock = threading.RLock()
+
+        if reopen:
+            self._load_meta()
+
+    def _allocate(self, name, shape, dtype, reopen):
+        if self.storage_dir is None:
+            return np.empty(shape, dtype=dtype)
+        path = self.storage_dir / f"{name}.npy"
+        if not reopen:
+            return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+        array = np.lib.format.open_memmap(path, mode="r+")
+        if array.shape != shape or array.dtype != dtype:
+            raise ValueError(f"{path} holds {array.dtype}{array.shape}, expected {np.dtype(dtype)}{shape}")
+        return array
+
+    ARRAYS = ("frames", "state_idx", "next_idx", "action", "reward", "done")
+
+    def _load_meta(self, path=None):
+        path = self.storage_dir if path is None else path
+        with open(path / "meta.json") as f:
+            meta = json.load(f)
+        self.frame_count = meta["frame_count"]
+        self.count = meta["count"]
+        self.tail = meta["tail"]
+        self._last_idx.clear()
+        self._last_ids.clear()
+        self._pending.clear()
+        print(f"Loaded replay buffer at {path} with {len(self)} transitions")
+
+    def _meta(self):
+        with self.lock:
+            return dict(frame_count=self.frame_count, count=self.count, tail=self.tail)
+
+    def _still_valid(self, meta):
+        """
+        Counters for arrays copied after `meta` was taken while add() kept running
+
+        add() only overwrites the oldest transitions and frames, so with the
+        current tail and frame count, the transitions up to the old count that
+        are still valid (see `_valid`) were left untouched by the copy.
+        """
+        with self.lock:
+            return dict(meta, tail=min(self.tail, meta["count"]), frame_count=self.frame_count)
+
+    def _write_meta(self, path, meta):
+        tmp_path = path / "meta.json.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        tmp_path.replace(path / "meta.json")
+
+    def flush(self):
+        """Write the mapped arrays and counters to disk so the buffer can be reopened, safe while add() runs"""
+        if self.storage_dir is None:
+            return
+        meta = self._meta()
+        for name in self.ARRAYS:
+            getattr(self, name).flush()
+        self._write_meta(self.storage_dir, self._still_valid(meta))
+
+    def save(self, path, chunk_size=4096):
+        """
+        Snapshot the buffer to the directory `path` as uncompressed .npy files
+
+        Arrays are streamed in chunks of `chunk_size` rows so saving never holds
+        a second copy of the frames in memory; frames stay uint8. The lock is
+        only held per chunk, so another thread can save while add() runs; the
+        snapshot then holds the transitions stored when the save started that
+        were not overwritten before it ended.
+        """
+        path = Path(path)
+        tmp_path = path.with_name(path.name + ".tmp")
+        if tmp_path.exists():
+            shutil.rmtree(tmp_path)
+        tmp_path.mkdir(parents=True)
+        meta = self._meta()
+        for name in self.ARRAYS:
+            array = getattr(self, name)
+            out = np.lib.format.open_memmap(tmp_path / f"{name}.npy", mode="w+", dtype=array.dtype, shape=array.shape)
+            for start in range(0, len(array), chunk_size):
+                with self.lock:
+                    out[start:start + chunk_size] = array[start:start + chunk_size]
+            out.flush()
+            del out
+        self._write_meta(tmp_path, self._still_valid(meta))
+        if path.exists():
+            shutil.rmtree(path)
+        tmp_path.rename(path)
+
+    def restore(self, path):
+        """
+        Load a snapshot written by `save()`
+
+        In RAM the snapshot is mapped copy-on-write, so pages are only read
+        from disk when sampled and writes never touch the snapshot. A disk-backed
+        buffer copies it into its own files instead.
+        """
+        path = Path(path)
+        with self.lock:
+            for name in self.ARRAYS:
+                array = getattr(self, name)
+                snapshot = np.load(path / f"{name}.npy", mmap_mode="c")
+                if snapshot.shape != array.shape or not np.can_cast(snapshot.dtype, array.dtype, "same_kind"):
+                    raise ValueError(f"{path / name} holds {snapshot.dtype}{snapshot.shape}, expected {array.dtype}{array.shape}")
+                if snapshot.dtype != array.dtype:
+                    # e.g. float64 rewards of older snapshots
+                    snapshot = snapshot.astype(array.dtype)
+                if self.storage_dir is None:
+                    setattr(self, name, snapshot)
+                else:
+                    array[:] = snapshot
+            self._load_meta(path)
+
+    def __len__(self):
+        return self.count - self.tail
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.frames, self.state_idx, self.next_idx, self.action, self.reward, self.done))
+
+    @staticmethod
+    def to_uint8(obs):
+        """Convert a stacked observation (LazyFrames, float in [0, 1] or uint8) to uint8"""
+        obs = np.asarray(obs)
+        if obs.dtype == np.uint8:
+            return obs
+        return np.rint(obs * 255).astype(np.uint8)
+
+    def _write_frame(self, frame):
+        pos = self.frame_count
+        self.frames[pos % self.frame_capacity] = frame
+        self.frame_count += 1
+
+        # Drop the oldest transitions referencing the frame we just overwrote,
+        # newer ones of streams that lag behind are skipped when sampled
+        while self.tail < self.count and not self._valid(self.tail % self.capacity):
+            self._drop_tail()
+        return pos
+
+    def _valid(self, idx):
+        """
+        Whether the transitions in slots `idx` still have all their frames
+
+        With interleaved streams transitions are not committed in frame order,
+        so slots after the tail can reference frames overwritten already.
+        """
+        oldest = self.frame_count - self.frame_capacity
+        return np.minimum(self.state_idx[idx].min(axis=-1), self.next_idx[idx].min(axis=-1)) >= oldest
+
+    def _drop_tail(self):
+        self.tail += 1
+
+    def _write_stack(self, stack):
+        """Write the frames of a stack, frames repeated back to back are stored once"""
+        idx = np.empty(self.stack, dtype=np.int64)
+        for i, frame in enumerate(stack):
+            if i > 0 and np.array_equal(frame, stack[i - 1]):
+                idx[i] = idx[i - 1]
+            else:
+                idx[i] = self._write_frame(frame)
+        return idx
+
+    def _stored(self, idx, stack):
+        """Check whether the frames at `idx` still hold `stack`"""
+        if idx[0] <= self.frame_count - self.frame_capacity:
+            return False
+        return np.array_equal(self.frames[idx % self.frame_capacity], stack)
+
+    def add(self, state, next_state, action, reward, done, stream=0, frame_ids=None):
+        """
+        Store a transition
+
+        Inputs:
+        state (LazyFrame or array of shape state_dim),
+        next_state (LazyFrame or array of shape state_dim),
+        action (int),
+        reward (float),
+        done (bool),
+        stream (hashable): env the transition comes from
+        frame_ids (array): optional ids of state[0] followed by next_state, see
+            wrappers.RingFrameStack; frames are then matched by id instead of content
+        """
+        with self.lock:
+            self._add(state, next_state, action, reward, done, stream, frame_ids)
+
+    def _locate_by_content(self, state, next_state, stream):
+        """Write the frames not stored yet, returns (state_idx, next_idx, whether state continues the stream)"""
+        state = self.to_uint8(state)
+        next_state = self.to_uint8(next_state)
+        last_idx = self._last_idx.get(stream)
+
+        continues = last_idx is not None and self._stored(last_idx, state)
+        state_idx = last_idx if continues else self._write_stack(state)
+
+        if np.array_equal(next_state[:-1], state[1:]):
+            next_idx = np.append(state_idx[1:], self._write_frame(next_state[-1]))
+        else:
+            next_idx = self._write_stack(next_state)
+        return state_idx, next_idx, continues
+
+    def _locate_by_ids(self, state, next_state, frame_ids, stream):
+        last_next_ids, known = self._last_ids.get(stream) or ((), {})
+        oldest = self.frame_count - self.frame_capacity
+
+        positions = {}
+        idx = np.empty(self.stack + 1, dtype=np.int64)
+        for j, frame_id in enumerate(frame_ids.tolist()):
+            pos = positions.get(frame_id, known.get(frame_id))
+            if pos is None or pos <= oldest:
+                pos = self._write_frame(self.to_uint8(state[0] if j == 0 else next_state[j - 1]))
+            positions[frame_id] = idx[j] = pos
+
+        continues = last_next_ids == tuple(frame_ids[:self.stack].tolist())
+        return idx[:-1], idx[1:], continues, (tuple(frame_ids[1:].tolist()), positions)
+
+    def _add(self, state, next_state, action, reward, done, stream, frame_ids=None):
+        pending = self._pending.setdefault(stream, deque())
+
+        if frame_ids is None:
+            state_idx, next_idx, continues = self._locate_by_content(state, next_state, stream)
+            self._last_idx[stream] = None if done else next_idx
+        else:
+            state_idx, next_idx, continues, last = self._locate_by_ids(state, next_state, np.asarray(frame_ids), stream)
+            self._last_ids[stream] = None if done else last
+
+        if not continues:
+            # The episode was cut without `done`, its last steps never get a full
+            # n-step return and are dropped.
+            pending.clear()
+
+        if self.n_step == 1:
+            self._commit(state_idx, next_idx, action, reward, done)
+            return
+
+        pending.append([state_idx, action, 0.0, 1.0])
+        for step in pending:
+            step[2] += step[3] * reward
+            step[3] *= self.gamma
+        if done:
+            while pending:
+                state_idx, action, ret, _ = pending.popleft()
+                self._commit(state_idx, next_idx, action, ret, True)
+        elif len(pending) == self.n_step:
+            state_idx, action, ret, _ = pending.popleft()
+            self._commit(state_idx, next_idx, action, ret, False)
+
+    def _commit(self, state_idx, next_idx, action, reward, done):
+        i = self.count % self.capacity
+        self.state_idx[i] = state_idx
+        self.next_idx[i] = next_idx
+        self.action[i] = action
+        self.reward[i] = reward
+        self.done[i] = done
+        self.count += 1
+        self.tail = max(self.tail, self.count - self.capacity)
+
+    def sample(self, batch_size):
+        """
+        Draw a uniform batch of transitions
+
+        Outputs:
+        state (uint8 array of shape (batch_size, *state_dim)),
+        next_state (uint8 array of shape (batch_size, *state_dim)),
+        action, reward, done (arrays of shape (batch_size,))
+        """
+        idx, _ = self.sample_idx(batch_size)
+        return self.gather(idx)
+
+    def sample_idx(self, batch_size):
+        """Draw the buffer slots of a batch, returns (idx, importance-sampling weights or None)"""
+        if len(self) < batch_size:
+            raise ValueError(f"Cannot sample {batch_size} transitions from a buffer of {len(self)}")
+        idx = (self.tail + self.rng.choice(len(self), batch_size, replace=False)) % self.capacity
+        for _ in range(10):
+            _, first = np.unique(idx, return_index=True)
+            redraw = ~self._valid(idx)
+            redraw[np.setdiff1d(np.arange(batch_size), first)] = True
+            if not redraw.any():
+                return idx, None
+            idx[redraw] = (self.tail + self.rng.integers(len(self), size=redraw.sum())) % self.capacity
+        # mostly invalid slots, draw among the valid ones only
+        live = (self.tail + np.arange(len(self))) % self.capacity
+        live = live[self._valid(live)]
+        if len(live) < batch_size:
+            raise ValueError(f"Cannot sample {batch_size} transitions from a buffer of {len(live)} valid ones")
+        return self.rng.choice(live, batch_size, replace=False), None
+
+    def transition_numbers(self, idx):
+        """No. of the transitions now in slots `idx`, changes whenever a slot is reused"""
+        return self.count - 1 - (self.count - 1 - np.asarray(idx)) % self.capacity
+
+    def gather(self, idx, out=None):
+        """Gather the transitions in slots `idx`, optionally into the preallocated arrays `out`"""
+        if out is None:
+            out = (None,) * 5
+        state = np.take(self.frames, self.state_idx[idx] % self.frame_capacity, axis=0, out=out[0])
+        next_state = np.take(self.frames, self.next_idx[idx] % self.frame_capacity, axis=0, out=out[1])
+        action = np.take(self.action, idx, out=out[2])
+        reward = np.take(self.reward, idx, out=out[3])
+        done = np.take(self.done, idx, out=out[4])
+        return state, next_state, action, reward, done
+
+
+class SumTree:
+    '''Binary tree over a flat array where every node holds the sum of its children
+
+    Leaves are the priorities of the buffer slots. Updates and prefix-sum
+    searches walk one root-to-leaf path, both are vectorized over a batch.
+    '''
+    def __init__(self, capacity):
+        self.capacity = int(capacity)
+        self.depth = max(1, int(np.ceil(np.log2(self.capacity))))
+        self.offset = 2 ** self.depth - 1  # index of the first leaf
+        self.tree = np.zeros(2 * self.offset + 1, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.tree[0]
+
+    def __getitem__(self, idx):
+        return self.tree[self.offset + np.asarray(idx)]
+
+    def update(self, idx, priority):
+        """Set the priorities of slots `idx` and refresh their ancestors"""
+        nodes = self.offset + np.asarray(idx, dtype=np.int64)
+        self.tree[nodes] = priority
+        for _ in range(self.depth):
+            nodes = np.unique((nodes - 1) // 2)
+            self.tree[nodes] = self.tree[2 * nodes + 1] + self.tree[2 * nodes + 2]
+
+    def find(self, value):
+        """Return the slots whose cumulative priority range contains each of `value`"""
+        value = np.array(value, dtype=np.float64)
+        nodes = np.zeros(len(value), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes + 1
+            # rounding can leave `value` at the left sum with nothing on the right
+            go_right = (value >= self.tree[left]) & (self.tree[left + 1] > 0)
+            value -= np.where(go_right, self.tree[left], 0.0)
+            nodes = np.where(go_right, left + 1, left)
+        return nodes - self.offset
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    '''Replay memory sampling transitions proportionally to priority ** alpha
+
+    New transitions get the highest priority seen so far, `update_priorities`
+    refreshes them from the TD errors of a batch sampled earlier. Importance-sampling
+    weights are annealed from `beta` to 1 over `beta_steps` batches.
+    '''
+    def __init__(self, capacity, state_dim, storage_dir=None, n_step=1, gamma=0.9, alpha=0.6, beta=0.4, beta_steps=1e6, eps=1e-6):
+        self.priorities = SumTree(capacity)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = (1.0 - beta) / beta_steps
+        self.eps = eps
+        self.max_priority = 1.0
+        super().__init__(capacity, state_dim, storage_dir=storage_dir, n_step=n_step, gamma=gamma)
+
+    def _load_meta(self, path=None):
+        super()._load_meta(path)
+        # priorities are not persisted, a reopened buffer starts uniform
+        self.priorities.update(np.arange(self.capacity), 0.0)
+        self.priorities.update((self.tail + np.arange(len(self))) % self.capacity, self.max_priority)
+
+    def _drop_tail(self):
+        self.priorities.update([self.tail % self.capacity], 0.0)
+        super()._drop_tail()
+
+    def _commit(self, state_idx, next_idx, action, reward, done):
+        slot = self.count % self.capacity
+        super()._commit(state_idx, next_idx, action, reward, done)
+        self.priorities.update([slot], self.max_priority ** self.alpha)
+
+    def sample_idx(self, batch_size):
+        if len(self) < batch_size:
+            raise ValueError(f"Cannot sample {batch_size} transitions from a buffer of {len(self)}")
+        while True:
+            # one draw per equal-mass segment of the priority range
+            total = self.priorities.total
+            if total <= 0:
+                raise ValueError(f"Cannot sample {batch_size} transitions, no valid one left")
+            value = (np.arange(batch_size) + self.rng.random(batch_size)) * (total / batch_size)
+            idx = self.priorities.find(np.minimum(value, np.nextafter(total, 0)))
+            invalid = ~self._valid(idx)
+            if not invalid.any():
+                break
+            # transitions of lagging streams whose frames were overwritten
+            self.priorities.update(idx[invalid], 0.0)
+
+        probs = self.priorities[idx] / total
+        weights = (len(self) * probs) ** -self.beta
+        weights /= weights.max()
+        self.beta = min(1.0, self.beta + self.beta_increment)
+        return idx, weights.astype(np.float32)
+
+    def update_priorities(self, numbers, td_error):
+        """
+        Set the priorities of the transitions `numbers` from their absolute TD errors
+
+        `numbers` come from `transition_numbers` when the batch was sampled; with
+        prefetching the batch is older than the last add(), and transitions dropped
+        or overwritten since are skipped so their slots keep their current priority.
+        """
+        numbers = np.asarray(numbers)
+        priority = np.abs(td_error) + self.eps
+        with self.lock:
+            idx = numbers % self.capacity
+            live = (numbers >= self.tail) & self._valid(idx)
+            if not live.any():
+                return
+            self.max_priority = max(self.max_priority, priority[live].max())
+            self.priorities.update(idx[live], priority[live] ** self.alpha)
+
+
+class BatchSampler:
+    '''Sample replay batches straight into reused (pinned) tensors
+
+    Each slot holds uint8 state tensors that the gather writes into directly,
+    plus the action/reward/done arrays `learn()` consumes and the transition
+    numbers of the batch. With `prefetch` a background thread fills the next
+    slots while the current gradient step runs; a slot is only refilled once
+    the batch after it has been handed out.
+    '''
+    def __init__(self, memory, batch_size, pin_memory=False, prefetch=True, slots=3):
+        self.memory = memory
+        self.batch_size = batch_size
+        self.pin_memory = pin_memory
+        self.prefetch = prefetch
+        self.slots = [self._allocate_slot() for _ in range(slots if prefetch else 1)]
+
+        self.free = queue.Queue()
+        for i in range(len(self.slots)):
+            self.free.put(i)
+        self.ready = queue.Queue()
+        self.current = None
+        self.thread = None
+
+    def _allocate_slot(self):
+        state_shape = (self.batch_size, self.memory.stack) + self.memory.frames.shape[1:]
+        # frames stay uint8, MarioNet scales them at its input
+        state = torch.empty(state_shape, dtype=torch.uint8, pin_memory=self.pin_memory)
+        next_state = torch.empty(state_shape, dtype=torch.uint8, pin_memory=self.pin_memory)
+        staging = (
+            state.numpy(),
+            next_state.numpy(),
+            np.empty(self.batch_size, dtype=self.memory.action.dtype),
+            np.empty(self.batch_size, dtype=self.memory.reward.dtype),
+            np.empty(self.batch_size, dtype=np.bool_),
+        )
+        return dict(staging=staging, state=state, next_state=next_state, idx=None, weights=None)
+
+    def _fill(self, slot):
+        with self.memory.lock:
+            idx, weights = self.memory.sample_idx(self.batch_size)
+            _, _, action, reward, done = self.memory.gather(idx, out=slot["staging"])
+            slot["idx"] = self.memory.transition_numbers(idx)
+        slot["action"], slot["reward"], slot["done"] = (torch.from_numpy(a) for a in (action, reward, done))
+        slot["weights"] = None if weights is None else torch.from_numpy(weights)
+
+    def _run(self):
+        while True:
+            i = self.free.get()
+            if i is None:
+                return
+            try:
+                self._fill(self.slots[i])
+            except Exception as e:
+                # re-raised by get() in the training thread
+                self.ready.put(e)
+                return
+            self.ready.put(i)
+
+    def get(self):
+        """
+        Return the next batch
+
+        Outputs:
+        idx (transition numbers), weights (tensor or None), state, next_state, action, reward, done (tensors)
+        """
+        if not self.prefetch:
+            slot = self.slots[0]
+            self._fill(slot)
+        else:
+            if self.thread is None:
+                # fail like the synchronous path instead of waiting for experiences
+                # that can only be cached by the thread calling us
+                if len(self.memory) < self.batch_size:
+                    raise ValueError(f"Cannot sample {self.batch_size} transitions from a buffer of {len(self.memory)}")
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            if self.current is not None:
+                self.free.put(self.current)
+            self.current = self.ready.get()
+            if isinstance(self.current, Exception):
+                raise self.current
+            slot = self.slots[self.current]
+        return slot["idx"], slot["weights"], slot["state"], slot["next_state"], slot["action"], slot["reward"], slot["done"]
+
+    def close(self):
+        """Stop the prefetch thread once it has filled the slots already handed back"""
+        if self.thread is None or not self.thread.is_alive():
+            return
+        # wakes the thread up when it is waiting for a free slot
+        self.free.put(None)
+        self.thread.join()
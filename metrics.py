@@ -1,81 +1,239 @@
 import numpy as np
-import time, datetime
+import atexit, json, time, datetime, queue
+import multiprocessing as mp
+from collections import deque
+import matplotlib
 import matplotlib.pyplot as plt
 from pathlib import Path
 
+
+class RollingMean():
+    '''Mean of the last `window` values, updated in O(1) with a running sum'''
+    def __init__(self, window=100):
+        self.values = deque(maxlen=window)
+        self.total = 0.0
+        self.appended = 0
+
+    def append(self, value):
+        if len(self.values) == self.values.maxlen:
+            self.total -= self.values[0]
+        self.values.append(value)
+        self.total += value
+        self.appended += 1
+        # re-sum once per window so float rounding never accumulates
+        if self.appended % self.values.maxlen == 0:
+            self.total = float(sum(self.values))
+
+    @property
+    def mean(self):
+        if not self.values:
+            return np.nan
+        return self.total / len(self.values)
+
+
+class ColumnLog():
+    '''Append-only table stored column by column as chunked .npy files
+
+    Rows are buffered in preallocated arrays and each full block of
+    `chunk_rows` rows is written as `path/<column>/<chunk>.npy`, so a single
+    column of a long run is read back with `read_column` without touching
+    the others.
+    '''
+    def __init__(self, path, columns, chunk_rows=1 << 16):
+        """
+        path (Path): directory of the table
+        columns (dict): column name -> numpy dtype
+        chunk_rows (int): no. of rows buffered before writing a chunk
+        """
+        self.path = Path(path)
+        self.columns = {name: np.dtype(dtype) for name, dtype in columns.items()}
+        self.chunk_rows = chunk_rows
+        for name in self.columns:
+            (self.path / name).mkdir(parents=True, exist_ok=True)
+        with open(self.path / "columns.json", "w") as f:
+            json.dump({name: dtype.str for name, dtype in self.columns.items()}, f)
+        self.buffers = {name: np.empty(chunk_rows, dtype=dtype) for name, dtype in self.columns.items()}
+        self.rows = 0  # rows in the buffers
+        self.chunks = 0  # chunks written
+
+    def append(self, **row):
+        for name, value in row.items():
+            self.buffers[name][self.rows] = value
+        self.rows += 1
+        if self.rows == self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if self.rows == 0:
+            return
+        for name, buffer in self.buffers.items():
+            np.save(self.path / name / f"{self.chunks:06d}.npy", buffer[:self.rows])
+        self.chunks += 1
+        self.rows = 0
+
+
+def read_column(path, column):
+    """All the values of one column of a ColumnLog table, e.g. read_column(save_dir / 'metrics' / 'steps', 'reward')"""
+    chunks = sorted((Path(path) / column).glob("*.npy"))
+    if not chunks:
+        with open(Path(path) / "columns.json") as f:
+            return np.empty(0, dtype=np.dtype(json.load(f)[column]))
+    return np.concatenate([np.load(chunk) for chunk in chunks])
+
+
+def _plot_worker(plots, points, history):
+    """Redraw the moving average plots from the points received, one figure per metric"""
+    matplotlib.use("Agg")
+    figures = {}
+    for metric in plots:
+        figure, axes = plt.subplots()
+        line, = axes.plot([], [])
+        figures[metric] = (figure, axes, line, deque(maxlen=history), deque(maxlen=history))
+    while True:
+        batch = points.get()
+        # only the last redraw of everything already queued matters
+        done = batch is None
+        while not done:
+            for metric, (x, y) in batch.items():
+                figures[metric][3].extend(x)
+                figures[metric][4].extend(y)
+            try:
+                batch = points.get_nowait()
+            except queue.Empty:
+                break
+            done = batch is None
+        for metric, (figure, axes, line, x, y) in figures.items():
+            line.set_data(x, y)
+            axes.relim()
+            axes.autoscale_view()
+            figure.savefig(plots[metric])
+        if done:
+            return
+
+
 class MetricLogger():
-    def __init__(self, save_dir):
+    METRICS = ("ep_rewards", "ep_lengths", "ep_avg_losses", "ep_avg_qs")
+
+    def __init__(self, save_dir, num_envs=1, plot_every=60, history=10000):
+        """
+        plot_every (float): min. seconds between plot redraws, done by a worker process
+        history (int): no. of episodes and records kept in memory and plotted
+        """
         self.save_log = save_dir / "log"
-        with open(self.save_log, "w") as f:
-            f.write(
-                f"{'Episode':>8}{'Step':>8}{'Epsilon':>10}{'MeanReward':>15}"
-                f"{'MeanLength':>15}{'MeanLoss':>15}{'MeanQValue':>15}"
-                f"{'TimeDelta':>15}{'Time':>20}\n"
-            )
+        # kept open, line-buffered so the log stays readable while training
+        self.log_file = open(self.save_log, "w", buffering=1)
+        self.log_file.write(
+            f"{'Episode':>8}{'Step':>8}{'Epsilon':>10}{'MeanReward':>15}"
+            f"{'MeanLength':>15}{'MeanLoss':>15}{'MeanQValue':>15}"
+            f"{'TimeDelta':>15}{'Time':>20}\n"
+        )
+        # every step and episode, read back with read_column
+        self.step_log = ColumnLog(
+            save_dir / "metrics" / "steps",
+            dict(time=np.float64, step=np.int64, env=np.int16, reward=np.float32, loss=np.float32, q=np.float32)
+        )
+        self.episode_log = ColumnLog(
+            save_dir / "metrics" / "episodes",
+            dict(time=np.float64, env=np.int16, reward=np.float32, length=np.int32, avg_loss=np.float32, avg_q=np.float32)
+        )
         self.ep_rewards_plot = save_dir / "reward_plot.jpg"
         self.ep_lengths_plot = save_dir / "length_plot.jpg"
         self.ep_avg_losses_plot = save_dir / "loss_plot.jpg"
         self.ep_avg_qs_plot = save_dir / "q_plot.jpg"
 
-        # History metrics
-        self.ep_rewards = []
-        self.ep_lengths = []
-        self.ep_avg_losses = []
-        self.ep_avg_qs = []
+        # History metrics, the means of the last 100 episodes are kept up to date as they end
+        self.ep_rewards = deque(maxlen=history)
+        self.ep_lengths = deque(maxlen=history)
+        self.ep_avg_losses = deque(maxlen=history)
+        self.ep_avg_qs = deque(maxlen=history)
+        self.rolling = {metric: RollingMean(100) for metric in self.METRICS}
 
         # Moving averages, added for every call to record()
-        self.moving_avg_ep_rewards = []
-        self.moving_avg_ep_lengths = []
-        self.moving_avg_ep_avg_losses = []
-        self.moving_avg_ep_avg_qs = []
+        self.moving_avg_ep_rewards = deque(maxlen=history)
+        self.moving_avg_ep_lengths = deque(maxlen=history)
+        self.moving_avg_ep_avg_losses = deque(maxlen=history)
+        self.moving_avg_ep_avg_qs = deque(maxlen=history)
+        self.records = 0
+
+        # Plotting runs in a worker process, fed with the moving averages recorded
+        # since the previous redraw. Forked so scripts without a __main__ guard work.
+        self.plot_every = plot_every
+        self.plot_time = 0.0
+        self.unplotted = {metric: ([], []) for metric in self.METRICS}
+        plots = {metric: getattr(self, f"{metric}_plot") for metric in self.METRICS}
+        ctx = mp.get_context("fork")
+        self.points = ctx.Queue()
+        self.plotter = ctx.Process(target=_plot_worker, args=(plots, self.points, history), daemon=True)
+        self.plotter.start()
+        atexit.register(self.close)
 
-        # Current episode metric
-        self.init_episode()
+        # Current episode metric, one slot per env in vectorized mode
+        self.num_envs = num_envs
+        self.curr_ep_reward = np.zeros(num_envs)
+        self.curr_ep_length = np.zeros(num_envs, dtype=np.int64)
+        self.curr_ep_loss = np.zeros(num_envs)
+        self.curr_ep_q = np.zeros(num_envs)
+        self.curr_ep_loss_length = np.zeros(num_envs, dtype=np.int64)
 
         # Timing
         self.record_time = time.time()
 
 
-    def log_step(self, reward, loss, q):
-        self.curr_ep_reward += reward
-        self.curr_ep_length += 1
+    def log_step(self, reward, loss, q, step, env=0):
+        "step (int): env step of the transition, lines the step log up with the records"
+        self.step_log.append(
+            time=time.time(), step=step, env=env, reward=reward,
+            loss=np.nan if loss is None else loss, q=np.nan if q is None else q
+        )
+        self.curr_ep_reward[env] += reward
+        self.curr_ep_length[env] += 1
         if loss:
-            self.curr_ep_loss += loss
-            self.curr_ep_q += q
-            self.curr_ep_loss_length += 1
+            self.curr_ep_loss[env] += loss
+            self.curr_ep_q[env] += q
+            self.curr_ep_loss_length[env] += 1
 
-    def log_episode(self):
+    def log_episode(self, env=0):
         "Mark end of episode"
-        self.ep_rewards.append(self.curr_ep_reward)
-        self.ep_lengths.append(self.curr_ep_length)
-        if self.curr_ep_loss_length == 0:
+        self.ep_rewards.append(float(self.curr_ep_reward[env]))
+        self.ep_lengths.append(int(self.curr_ep_length[env]))
+        if self.curr_ep_loss_length[env] == 0:
             ep_avg_loss = 0
             ep_avg_q = 0
         else:
-            ep_avg_loss = np.round(self.curr_ep_loss / self.curr_ep_loss_length, 5)
-            ep_avg_q = np.round(self.curr_ep_q / self.curr_ep_loss_length, 5)
+            ep_avg_loss = np.round(self.curr_ep_loss[env] / self.curr_ep_loss_length[env], 5)
+            ep_avg_q = np.round(self.curr_ep_q[env] / self.curr_ep_loss_length[env], 5)
         self.ep_avg_losses.append(ep_avg_loss)
         self.ep_avg_qs.append(ep_avg_q)
+        for metric in self.METRICS:
+            self.rolling[metric].append(getattr(self, metric)[-1])
+        self.episode_log.append(
+            time=time.time(), env=env, reward=self.ep_rewards[-1], length=self.ep_lengths[-1],
+            avg_loss=ep_avg_loss, avg_q=ep_avg_q
+        )
 
-        self.init_episode()
+        self.init_episode(env)
 
-    def init_episode(self):
-        self.curr_ep_reward = 0.0
-        self.curr_ep_length = 0
-        self.curr_ep_loss = 0.0
-        self.curr_ep_q = 0.0
-        self.curr_ep_loss_length = 0
+    def init_episode(self, env=0):
+        self.curr_ep_reward[env] = 0.0
+        self.curr_ep_length[env] = 0
+        self.curr_ep_loss[env] = 0.0
+        self.curr_ep_q[env] = 0.0
+        self.curr_ep_loss_length[env] = 0
 
     def record(self, episode, epsilon, step):
-        mean_ep_reward = np.round(np.mean(self.ep_rewards[-100:]), 3)
-        mean_ep_length = np.round(np.mean(self.ep_lengths[-100:]), 3)
-        mean_ep_loss = np.round(np.mean(self.ep_avg_losses[-100:]), 3)
-        mean_ep_q = np.round(np.mean(self.ep_avg_qs[-100:]), 3)
+        mean_ep_reward = np.round(self.rolling["ep_rewards"].mean, 3)
+        mean_ep_length = np.round(self.rolling["ep_lengths"].mean, 3)
+        mean_ep_loss = np.round(self.rolling["ep_avg_losses"].mean, 3)
+        mean_ep_q = np.round(self.rolling["ep_avg_qs"].mean, 3)
         self.moving_avg_ep_rewards.append(mean_ep_reward)
         self.moving_avg_ep_lengths.append(mean_ep_length)
         self.moving_avg_ep_avg_losses.append(mean_ep_loss)
         self.moving_avg_ep_avg_qs.append(mean_ep_q)
-
+        for metric in self.METRICS:
+            x, y = self.unplotted[metric]
+            x.append(self.records)
+            y.append(getattr(self, f"moving_avg_{metric}")[-1])
+        self.records += 1
 
         last_record_time = self.record_time
         self.record_time = time.time()
@@ -93,15 +251,29 @@ class MetricLogger():
             f"Time {datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')}"
         )
 
-        with open(self.save_log, "a") as f:
-            f.write(
-                f"{episode:8d}{step:8d}{epsilon:10.3f}"
-                f"{mean_ep_reward:15.3f}{mean_ep_length:15.3f}{mean_ep_loss:15.3f}{mean_ep_q:15.3f}"
-                f"{time_since_last_record:15.3f}"
-                f"{datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S'):>20}\n"
-            )
-
-        for metric in ["ep_rewards", "ep_lengths", "ep_avg_losses", "ep_avg_qs"]:
-            plt.plot(getattr(self, f"moving_avg_{metric}"))
-            plt.savefig(getattr(self, f"{metric}_plot"))
-            plt.clf()
+        self.log_file.write(
+            f"{episode:8d}{step:8d}{epsilon:10.3f}"
+            f"{mean_ep_reward:15.3f}{mean_ep_length:15.3f}{mean_ep_loss:15.3f}{mean_ep_q:15.3f}"
+            f"{time_since_last_record:15.3f}"
+            f"{datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S'):>20}\n"
+        )
+
+        if self.record_time - self.plot_time >= self.plot_every:
+            self.plot()
+
+    def plot(self):
+        """Send the moving averages recorded since the previous redraw to the plot worker"""
+        self.plot_time = time.time()
+        self.points.put(self.unplotted)
+        self.unplotted = {metric: ([], []) for metric in self.METRICS}
+
+    def close(self):
+        """Write the buffered metrics, draw the last records and wait for the plot worker"""
+        if not self.plotter.is_alive():
+            return
+        self.step_log.flush()
+        self.episode_log.flush()
+        self.log_file.close()
+        self.plot()
+        self.points.put(None)
+        self.plotter.join()
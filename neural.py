@@ -1,11 +1,13 @@
+import torch
 from torch import nn
-import copy
+import copy, warnings
 
 class MarioNet(nn.Module):
     '''mini cnn structure
     input -> (conv2d + relu) x 3 -> flatten -> (dense + relu) x 2 -> output
     '''
-    def __init__(self, input_dim, output_dim):
+    def __init__(self, input_dim, output_dim, target=True):
+        """target=False builds the online network only, for inference"""
         super().__init__()
         c, h, w = input_dim
 
@@ -27,13 +29,89 @@ class MarioNet(nn.Module):
             nn.Linear(512, output_dim)
         )
 
-        self.target = copy.deepcopy(self.online)
+        self.target = copy.deepcopy(self.online) if target else None
 
         # Q_target parameters are frozen.
-        for p in self.target.parameters():
-            p.requires_grad = False
+        if self.target is not None:
+            for p in self.target.parameters():
+                p.requires_grad = False
+
+        # compiled versions of the heads, kept out of the submodules so state_dict is unchanged
+        self.compiled = {}
+        self.compile_mode = None
+        self.channels_last = False
+
+    def compile_heads(self, mode, example, channels_last=False, freeze_online=False):
+        """
+        Opt-in compiled execution of both heads, falls back to eager if compiling fails
+
+        Inputs:
+        mode (str): 'trace' or 'script' for TorchScript, 'compile' for torch.compile
+        example (tensor): float input of shape (batch, c, h, w) on the model's device, used to trace
+        channels_last (bool): keep the weights and inputs in NHWC, helps on CUDA and oneDNN CPUs
+        freeze_online (bool): also freeze the online weights, only for inference without training
+        """
+        if mode not in ('trace', 'script', 'compile'):
+            raise ValueError(f"Unknown compile mode: {mode}")
+        self.compile_mode = mode
+        self.channels_last = channels_last
+        self.freeze_online = freeze_online
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+        self.example = self._format(example)
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', FutureWarning)
+                if mode == 'compile':
+                    # shares the parameters, the target needs no refresh after a sync
+                    self.compiled = {'online': torch.compile(self.online)}
+                    if self.target is not None:
+                        self.compiled['target'] = torch.compile(self.target)
+                else:
+                    # traced/scripted modules share the parameters, so the online
+                    # head keeps training through them, the target is frozen
+                    self.compiled = {'online': self._script(self.online, freeze=freeze_online)}
+                    self.refresh()
+                for model in self.compiled.values():
+                    with torch.no_grad():
+                        model(self.example)
+        except Exception as e:
+            warnings.warn(f"Compiling MarioNet with {mode} failed, running eager: {e}")
+            self.compiled = {}
+            self.compile_mode = None
+
+    def _script(self, module, freeze):
+        if self.compile_mode == 'script':
+            scripted = torch.jit.script(module)
+        else:
+            scripted = torch.jit.trace(module, self.example)
+        if freeze:
+            scripted = torch.jit.freeze(scripted.eval())
+        return scripted
+
+    def refresh(self):
+        """Re-freeze the TorchScript heads holding a copy of the weights, call after they changed"""
+        if self.compile_mode not in ('trace', 'script') or self.target is None:
+            return
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)
+            self.compiled['target'] = self._script(self.target, freeze=True)
+            if self.freeze_online:
+                self.compiled['online'] = self._script(self.online, freeze=True)
+
+    def _format(self, input):
+        if self.channels_last:
+            return input.contiguous(memory_format=torch.channels_last)
+        return input
 
     def forward(self, input, model):
+        # frames stay uint8 until here, the layers expect float values in [0, 1]
+        if input.dtype == torch.uint8:
+            input = input.float().div_(255)
+        else:
+            input = input.float()
+        if self.compiled:
+            return self.compiled[model](self._format(input))
         if model == 'online':
             return self.online(input)
         elif model == 'target':
@@ -74,7 +74,7 @@ for life in range(1, LIVES + 1):
         total_reward += reward
         steps += 1
         max_x_pos = max(max_x_pos, info.get("x_pos", 0))
-        logger.log_step(reward, info.get("coins"), info.get("score"))
+        logger.log_step(reward, info.get("coins"), info.get("score"), steps)
 
 # ----- FIN DE JEU -----
 end_time = time.time()
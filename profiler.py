@@ -0,0 +1,177 @@
+import datetime, os, resource, time
+from collections import defaultdict
+
+
+class Histogram:
+    '''Counts of durations in fixed log-spaced bins, 2 ** `bits` bins per doubling from 1 ns'''
+    def __init__(self, bits=2, octaves=40):
+        self.bits = bits
+        self.per_octave = 1 << bits
+        self.counts = [0] * (self.per_octave * octaves)
+        self.count = 0
+        self.total = 0
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.total = 0
+
+    def add(self, ns):
+        self.count += 1
+        self.total += ns
+        # octave from the bit length, sub-bin from the next `bits` bits, no log needed
+        octave = ns.bit_length() - 1
+        if octave < self.bits:
+            index = ns
+        else:
+            index = (octave << self.bits) | ((ns >> (octave - self.bits)) & (self.per_octave - 1))
+        self.counts[min(index, len(self.counts) - 1)] += 1
+
+    def upper_bound(self, index):
+        if index < self.per_octave:
+            return index + 1
+        octave, sub = index >> self.bits, index & (self.per_octave - 1)
+        return (self.per_octave + sub + 1) << (octave - self.bits)
+
+    def quantile(self, q):
+        """Upper bound in ns of the bin holding the q-quantile"""
+        target, seen = q * self.count, 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return self.upper_bound(index)
+        return 0.0
+
+
+class _Phase:
+    '''Reusable context manager timing one phase, cheaper than a generator-based one'''
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+
+    def __exit__(self, *exc):
+        self.histogram.add(time.perf_counter_ns() - self.start)
+
+
+class _Disabled:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+def rss_bytes():
+    """Resident set size of this process, the peak one where /proc is not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Profiler:
+    '''Time the phases of the training loop with monotonic counters
+
+    `with profiler.phase('act'):` adds the duration of the block to the
+    histogram of that phase; disabled, the phases are no-ops. `report()`
+    writes p50/p99 and the share of wall time of every phase since the
+    previous report to `save_path`, with the process RSS and replay bytes.
+    '''
+    def __init__(self, save_path=None, enabled=True, report_every=60):
+        self.enabled = enabled
+        self.save_path = save_path
+        self.report_every = report_every
+        self.histograms = defaultdict(Histogram)
+        self.phases = {}
+        self.disabled = _Disabled()
+        self.window_start = time.perf_counter_ns()
+        self.report_time = time.time()
+        if self.enabled and self.save_path is not None:
+            with open(self.save_path, "w") as f:
+                f.write(
+                    f"{'Step':>10}{'Phase':>40}{'Count':>10}{'Share':>8}{'Self':>8}"
+                    f"{'p50(us)':>12}{'p99(us)':>12}{'RSS(MB)':>10}{'Replay(MB)':>12}{'Time':>20}\n"
+                )
+
+    def phase(self, name):
+        if not self.enabled:
+            return self.disabled
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = _Phase(self.histograms[name])
+        return phase
+
+    def profile_env(self, env):
+        """
+        Time `step` of every layer of a wrapped env under 'env.step/<Layer>'
+
+        Times are inclusive of the layers below, the report derives each layer's
+        own share; the innermost layer is the emulation.
+        """
+        if not self.enabled:
+            return env
+        layers = []
+        layer = env
+        while layer is not None:
+            layers.append(layer)
+            layer = getattr(layer, "env", None)
+        for depth, layer in enumerate(layers):
+            # the SaveStatePool switches between several inner envs
+            for inner in [layer] + list(getattr(layer, "envs", [])):
+                name = f"env.step/{depth:02d}.{type(inner).__name__}"
+                inner.step = self._timed(inner.step, name)
+        return env
+
+    def _timed(self, step, name):
+        phase = self.phase(name)
+
+        def timed_step(action):
+            with phase:
+                return step(action)
+        return timed_step
+
+    def summary(self):
+        """(phase, count, share of wall time, self share, p50 ns, p99 ns) since the previous report"""
+        wall = max(time.perf_counter_ns() - self.window_start, 1)
+        names = sorted(self.histograms)
+        env_layers = [name for name in names if name.startswith("env.step/")]
+        rows = []
+        for name in names:
+            histogram = self.histograms[name]
+            own = histogram.total
+            if name in env_layers and env_layers.index(name) + 1 < len(env_layers):
+                own -= self.histograms[env_layers[env_layers.index(name) + 1]].total
+            rows.append((name, histogram.count, histogram.total / wall, own / wall,
+                         histogram.quantile(0.5), histogram.quantile(0.99)))
+        return rows
+
+    def report(self, step, memory=None, force=False):
+        """Write and reset the phase statistics, at most every `report_every` seconds unless forced"""
+        if not self.enabled or (not force and time.time() - self.report_time < self.report_every):
+            return
+        rss = rss_bytes() / 2 ** 20
+        replay = memory.nbytes / 2 ** 20 if memory is not None else 0.0
+        now = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        lines = [
+            f"{step:10d}{name:>40}{count:10d}{share:8.2%}{own:8.2%}"
+            f"{p50 / 1e3:12.1f}{p99 / 1e3:12.1f}{rss:10.1f}{replay:12.1f}{now:>20}\n"
+            for name, count, share, own, p50, p99 in self.summary()
+        ]
+        print(f"Profile at step {step} - RSS {rss:.1f} MB - Replay {replay:.1f} MB")
+        print("".join(lines), end="")
+        if self.save_path is not None:
+            with open(self.save_path, "a") as f:
+                f.writelines(lines)
+
+        for histogram in self.histograms.values():
+            histogram.reset()
+        self.window_start = time.perf_counter_ns()
+        self.report_time = time.time()
@@ -0,0 +1,168 @@
+"""
+Export a `mario_net_N.chkpt` to an int8, online-only MarioNet for CPU inference
+
+The convolutions are quantized statically, calibrated on recorded states, and
+the Linear layers dynamically. The export is checked against the fp32 model by
+the share of states on which both pick the same action.
+
+    python quantize.py checkpoints/2025-06-30T08-55-23/mario_net_4.chkpt [states.npy]
+
+Without a states file, states are recorded by playing the fp32 model and saved
+next to the checkpoint. The model is written to `mario_net_N.int8.pt` and loaded
+with `QuantizedPolicy`, see replay.py.
+"""
+import os
+os.environ['KMP_DUPLICATE_LIB_OK']='True'
+
+import copy, sys, time
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch import nn
+from torch.ao import quantization
+
+from neural import MarioNet
+
+
+class QuantizableMarioNet(nn.Module):
+    '''MarioNet.online split at the flatten, with quant stubs around the convs'''
+    def __init__(self, online):
+        super().__init__()
+        self.quant = quantization.QuantStub()
+        self.convs = online[:6]
+        self.dequant = quantization.DeQuantStub()
+        self.head = online[6:]
+
+    def forward(self, input):
+        if input.dtype == torch.uint8:
+            input = input.float().div_(255)
+        x = self.dequant(self.convs(self.quant(input)))
+        return self.head(x)
+
+
+def load_online(checkpoint, state_dim=(4, 84, 84), action_dim=2):
+    """fp32 online head of a checkpoint, on CPU"""
+    ckp = torch.load(checkpoint, map_location='cpu')
+    net = MarioNet(state_dim, action_dim).float()
+    net.load_state_dict(ckp.get('model'))
+    return net.online.eval()
+
+
+def quantize(online, calibration_states, batch_size=64):
+    """
+    Inputs:
+    online (nn.Sequential): fp32 MarioNet.online
+    calibration_states (uint8 array of shape (N, c, h, w)): states the conv activations are calibrated on
+    Outputs:
+    model (nn.Module): int8 model taking uint8 or [0, 1] float states
+    """
+    engine = torch.backends.quantized.engine
+    model = QuantizableMarioNet(copy.deepcopy(online)).eval()
+    quantization.fuse_modules(model.convs, [['0', '1'], ['2', '3'], ['4', '5']], inplace=True)
+    # static for the convs, the head is quantized dynamically below
+    model.qconfig = quantization.get_default_qconfig(engine)
+    model.head.qconfig = None
+    quantization.prepare(model, inplace=True)
+    with torch.no_grad():
+        for start in range(0, len(calibration_states), batch_size):
+            model(torch.from_numpy(calibration_states[start:start + batch_size]))
+    quantization.convert(model, inplace=True)
+    model.head = quantization.quantize_dynamic(model.head, {nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def agreement(online, model, states, batch_size=256):
+    """Share of states where both models pick the same action, and the max. Q-value difference"""
+    same, max_diff = 0, 0.0
+    with torch.no_grad():
+        for start in range(0, len(states), batch_size):
+            batch = torch.from_numpy(states[start:start + batch_size])
+            q = online(batch.float().div_(255))
+            q_int8 = model(batch)
+            same += (q.argmax(dim=1) == q_int8.argmax(dim=1)).sum().item()
+            max_diff = max(max_diff, (q - q_int8).abs().max().item())
+    return same / len(states), max_diff
+
+
+def latency(model, state, repeat=200):
+    """ms per greedy action on a single state"""
+    with torch.no_grad():
+        model(state)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            model(state).argmax(dim=1).item()
+    return (time.perf_counter() - start) / repeat * 1e3
+
+
+def record_states(online, num_states, stage='SuperMarioBros-1-1-v0', exploration_rate=0.1):
+    """Play the fp32 model epsilon-greedily and keep the states it saw"""
+    from wrappers import make_env
+
+    env = make_env(stage)
+    states = []
+    state = env.reset()
+    while len(states) < num_states:
+        states.append(np.array(state, dtype=np.uint8))
+        if np.random.rand() < exploration_rate:
+            action = env.action_space.sample()
+        else:
+            with torch.no_grad():
+                action = online(torch.from_numpy(states[-1]).float().div_(255).unsqueeze(0)).argmax(dim=1).item()
+        state, reward, done, info = env.step(action)
+        if done or info['flag_get']:
+            state = env.reset()
+    env.close()
+    return np.stack(states)
+
+
+class QuantizedPolicy:
+    '''Epsilon-greedy actions from an exported int8 model, the inference part of Mario.act'''
+    def __init__(self, path, action_dim=2, exploration_rate=0.0):
+        torch.set_num_threads(1)
+        self.model = torch.jit.load(str(path), map_location='cpu')
+        self.action_dim = action_dim
+        self.exploration_rate = exploration_rate
+        self.curr_step = 0
+
+    def act(self, state):
+        self.curr_step += 1
+        if np.random.rand() < self.exploration_rate:
+            return np.random.randint(self.action_dim)
+        state = torch.as_tensor(np.asarray(state)).unsqueeze(0)
+        with torch.no_grad():
+            return self.model(state).argmax(dim=1).item()
+
+
+if __name__ == '__main__':
+    checkpoint = Path(sys.argv[1])
+    states_path = Path(sys.argv[2]) if len(sys.argv) > 2 else checkpoint.with_suffix('.states.npy')
+    num_states = 2000 # recorded when states_path does not exist, half calibrate, half check
+
+    online = load_online(checkpoint)
+    if states_path.exists():
+        states = np.load(states_path)
+    else:
+        states = record_states(online, num_states)
+        np.save(states_path, states)
+        print(f"Recorded {len(states)} states to {states_path}")
+
+    # calibrate and check on different states
+    order = np.random.default_rng(0).permutation(len(states))
+    calibration, evaluation = states[order[::2]], states[order[1::2]]
+    model = quantize(online, calibration)
+
+    same, max_diff = agreement(online, model, evaluation)
+    state = torch.from_numpy(evaluation[:1])
+    fp32_ms = latency(lambda x: online(x.float().div_(255)), state)
+    int8_ms = latency(model, state)
+    print(
+        f"Action agreement with fp32 {same:.2%} over {len(evaluation)} states - "
+        f"Max Q difference {max_diff:.4f} - "
+        f"fp32 {fp32_ms:.3f} ms/action - "
+        f"int8 {int8_ms:.3f} ms/action"
+    )
+
+    save_path = checkpoint.with_suffix('.int8.pt')
+    torch.jit.save(torch.jit.trace(model, state), str(save_path))
+    print(f"Quantized model saved to {save_path}")
@@ -1,28 +1,12 @@
 import random, datetime
 from pathlib import Path
 
-import gym
-import gym_super_mario_bros
-from gym.wrappers import FrameStack, GrayScaleObservation, TransformObservation
-from nes_py.wrappers import JoypadSpace
-
 from metrics import MetricLogger
-from agent import Mario
-from wrappers import ResizeObservation, SkipFrame
-
-env = gym_super_mario_bros.make('SuperMarioBros-v0')
-
-env = JoypadSpace(
-    env,
-    [['right'],
-    ['right', 'A']]
-)
+from agent import MarioPolicy
+from wrappers import make_env
+from quantize import QuantizedPolicy
 
-env = SkipFrame(env, skip=4)
-env = GrayScaleObservation(env, keep_dim=False)
-env = ResizeObservation(env, shape=84)
-env = TransformObservation(env, f=lambda x: x / 255.)
-env = FrameStack(env, num_stack=4)
+env = make_env('SuperMarioBros-v0')
 
 env.reset()
 
@@ -30,8 +14,15 @@ save_dir = Path('checkpoints') / datetime.datetime.now().strftime('%Y-%m-%dT%H-%
 save_dir.mkdir(parents=True)
 
 checkpoint = Path('checkpoints/2025-06-30T08-55-23/mario_net_4.chkpt')
-mario = Mario(state_dim=(4, 84, 84), action_dim=env.action_space.n, save_dir=save_dir, checkpoint=checkpoint)
-mario.exploration_rate = mario.exploration_rate_min
+exploration_rate = 0.1 # Mario.exploration_rate_min
+
+# int8 export of the checkpoint made by quantize.py, acts instead of the fp32 MarioNet
+quantized = None # checkpoint.with_suffix('.int8.pt')
+if quantized:
+    mario = QuantizedPolicy(quantized, env.action_space.n, exploration_rate)
+else:
+    # online weights only, see benchmarks/startup.py
+    mario = MarioPolicy(checkpoint, state_dim=(4, 84, 84), action_dim=env.action_space.n, exploration_rate=exploration_rate)
 
 logger = MetricLogger(save_dir)
 
@@ -49,9 +40,7 @@ for e in range(episodes):
 
         next_state, reward, done, info = env.step(action)
 
-        mario.cache(state, next_state, action, reward, done)
-
-        logger.log_step(reward, None, None)
+        logger.log_step(reward, None, None, mario.curr_step)
 
         state = next_state
 
@@ -0,0 +1,167 @@
+"""
+Query the MetricLogger logs of every run under checkpoints/ and logs_humain/
+
+    python runs.py best                 best mean reward of each run
+    python runs.py at-step 100000       mean reward of each run at that step
+    python runs.py slowest --limit 10   records with the longest TimeDelta
+    python runs.py sql "SELECT ..."     any query on the runs/records tables
+
+Each call first refreshes an SQLite index (runs.sqlite): logs whose size and
+mtime did not change are skipped, logs that only grew are parsed from where
+the previous refresh stopped, others are parsed again.
+"""
+import argparse, sqlite3
+from pathlib import Path
+
+ROOTS = (Path('checkpoints'), Path('logs_humain'))
+
+# Fixed-width columns written by MetricLogger.record
+COLUMNS = ('episode', 'step', 'epsilon', 'mean_reward', 'mean_length', 'mean_loss', 'mean_q', 'time_delta', 'time')
+WIDTHS = (8, 8, 10, 15, 15, 15, 15, 15, 20)
+TYPES = (int, int, float, float, float, float, float, float, str)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE,
+    kind TEXT,
+    mtime_ns INTEGER,
+    size INTEGER,
+    offset INTEGER,
+    checkpoints INTEGER
+);
+CREATE TABLE IF NOT EXISTS records (
+    run_id INTEGER REFERENCES runs(id),
+    episode INTEGER, step INTEGER, epsilon REAL,
+    mean_reward REAL, mean_length REAL, mean_loss REAL, mean_q REAL,
+    time_delta REAL, time TEXT
+);
+CREATE INDEX IF NOT EXISTS records_run_step ON records (run_id, step);
+"""
+
+
+def parse_line(line):
+    """Values of one log line, None for the header or a malformed line"""
+    fields = line.split()
+    if len(fields) != len(COLUMNS):
+        # a value wider than its column runs into the previous one
+        fields, start = [], 0
+        for width in WIDTHS:
+            fields.append(line[start:start + width].strip())
+            start += width
+    try:
+        return tuple(cast(field) for cast, field in zip(TYPES, fields))
+    except ValueError:
+        return None
+
+
+def find_logs(roots=ROOTS):
+    for root in roots:
+        for log in sorted(root.glob('**/log')):
+            if log.is_file():
+                yield root.name, log
+
+
+def refresh(db, roots=ROOTS):
+    """Bring the index up to date with the logs on disk, returns the no. of logs parsed"""
+    known = {path: (run_id, mtime_ns, size, offset) for run_id, path, mtime_ns, size, offset
+             in db.execute("SELECT id, path, mtime_ns, size, offset FROM runs")}
+    seen, parsed = set(), 0
+    for kind, log in find_logs(roots):
+        path = str(log.parent)
+        seen.add(path)
+        stat = log.stat()
+        checkpoints = sum(1 for _ in log.parent.glob('mario_net_*.chkpt'))
+        run_id, mtime_ns, size, offset = known.get(path, (None, None, None, 0))
+        if (mtime_ns, size) == (stat.st_mtime_ns, stat.st_size):
+            continue
+        if run_id is None:
+            run_id = db.execute("INSERT INTO runs (path, kind, offset) VALUES (?, ?, 0)", (path, kind)).lastrowid
+        elif size is None or stat.st_size < size:
+            # rewritten, not appended to
+            db.execute("DELETE FROM records WHERE run_id = ?", (run_id,))
+            offset = 0
+
+        with open(log, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+        # a partly written last line is parsed on the next refresh
+        end = data.rfind(b'\n') + 1
+        rows = (parse_line(line) for line in data[:end].decode().splitlines())
+        db.executemany(
+            f"INSERT INTO records (run_id, {', '.join(COLUMNS)}) VALUES (?, {', '.join('?' * len(COLUMNS))})",
+            ((run_id, *row) for row in rows if row is not None)
+        )
+        db.execute(
+            "UPDATE runs SET mtime_ns = ?, size = ?, offset = ?, checkpoints = ? WHERE id = ?",
+            (stat.st_mtime_ns, stat.st_size, offset + end, checkpoints, run_id)
+        )
+        parsed += 1
+
+    for path, (run_id, *_) in known.items():
+        if path not in seen:
+            db.execute("DELETE FROM records WHERE run_id = ?", (run_id,))
+            db.execute("DELETE FROM runs WHERE id = ?", (run_id,))
+    db.commit()
+    return parsed
+
+
+QUERIES = {
+    'best': """
+        SELECT runs.path, MAX(mean_reward) AS best_reward, step, episode, runs.checkpoints
+        FROM records JOIN runs ON runs.id = records.run_id
+        GROUP BY run_id ORDER BY best_reward DESC LIMIT ?
+    """,
+    'at-step': """
+        SELECT runs.path, step, mean_reward, mean_length, epsilon
+        FROM records JOIN runs ON runs.id = records.run_id
+        WHERE records.rowid IN (
+            SELECT (SELECT rowid FROM records AS r WHERE r.run_id = runs.id AND r.step <= ? ORDER BY r.step DESC LIMIT 1)
+            FROM runs
+        )
+        ORDER BY mean_reward DESC LIMIT ?
+    """,
+    'slowest': """
+        SELECT runs.path, episode, step, time_delta, time
+        FROM records JOIN runs ON runs.id = records.run_id
+        ORDER BY time_delta DESC LIMIT ?
+    """,
+}
+
+
+def print_rows(cursor):
+    names = [column[0] for column in cursor.description]
+    rows = [[f"{value:.3f}" if isinstance(value, float) else str(value) for value in row] for row in cursor]
+    widths = [max([len(name)] + [len(row[i]) for row in rows]) for i, name in enumerate(names)]
+    print("  ".join(name.rjust(width) for name, width in zip(names, widths)))
+    for row in rows:
+        print("  ".join(value.rjust(width) for value, width in zip(row, widths)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Query the training/play logs of all runs")
+    parser.add_argument('--db', default='runs.sqlite', help="index file, rebuilt from the logs if deleted")
+    limit = argparse.ArgumentParser(add_help=False)
+    limit.add_argument('--limit', type=int, default=20, help="max. no. of rows printed")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('best', parents=[limit], help="best 100-episode mean reward of each run")
+    at_step = commands.add_parser('at-step', parents=[limit], help="last record of each run at or before a step")
+    at_step.add_argument('step', type=int)
+    commands.add_parser('slowest', parents=[limit], help="records with the longest time between two records")
+    sql = commands.add_parser('sql', help="run a query on the runs and records tables")
+    sql.add_argument('query')
+    args = parser.parse_args()
+
+    db = sqlite3.connect(args.db)
+    db.executescript(SCHEMA)
+    parsed = refresh(db)
+    if parsed:
+        print(f"Indexed {parsed} new or changed logs")
+
+    if args.command == 'at-step':
+        cursor = db.execute(QUERIES['at-step'], (args.step, args.limit))
+    elif args.command == 'sql':
+        cursor = db.execute(args.query)
+    else:
+        cursor = db.execute(QUERIES[args.command], (args.limit,))
+    print_rows(cursor)
@@ -0,0 +1,133 @@
+"""
+Evaluate every checkpoint under checkpoints/ and rank them
+
+    python sweep.py --stages SuperMarioBros-1-1-v0 --episodes 5 --workers 8
+
+Uncached checkpoints are evaluated together, as many at a time as every stage
+of each gets at least one of the `--workers` env processes, see
+evaluate.evaluate_many.
+
+Results are cached in checkpoints/sweep_cache.json, keyed by the SHA-256 of
+the checkpoint file and the evaluation config, so a new sweep only evaluates
+checkpoints it has not seen with that config (a renamed or copied file is
+not evaluated again). File hashes are themselves reused while a file's size
+and mtime do not change.
+"""
+import os
+os.environ['KMP_DUPLICATE_LIB_OK']='True'
+
+import argparse, hashlib, json
+from pathlib import Path
+
+import numpy as np
+
+from evaluate import evaluate_many
+
+CACHE = Path('checkpoints') / 'sweep_cache.json'
+
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultsCache:
+    '''Evaluation summaries by (checkpoint hash, config), saved after every new result'''
+    def __init__(self, path=CACHE):
+        self.path = Path(path)
+        self.data = dict(files={}, results={})
+        if self.path.exists():
+            with open(self.path) as f:
+                self.data = json.load(f)
+
+    def hash(self, checkpoint):
+        """Content hash of a checkpoint, recomputed only when its size or mtime changed"""
+        stat = checkpoint.stat()
+        known = self.data['files'].get(str(checkpoint))
+        if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['sha256']
+        sha256 = file_hash(checkpoint)
+        self.data['files'][str(checkpoint)] = dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=sha256)
+        return sha256
+
+    @staticmethod
+    def key(sha256, config):
+        return f"{sha256}:{json.dumps(config, sort_keys=True)}"
+
+    def get(self, sha256, config):
+        return self.data['results'].get(self.key(sha256, config))
+
+    def put(self, sha256, config, summary):
+        self.data['results'][self.key(sha256, config)] = summary
+        self.save()
+
+    def save(self):
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f)
+        os.replace(tmp_path, self.path)
+
+
+def find_checkpoints(root=Path('checkpoints')):
+    return sorted(root.glob('**/mario_net_*.chkpt'))
+
+
+def summarize(results):
+    stages = results['stages'].values()
+    return dict(
+        mean_reward=float(np.mean([stage['mean_reward'] for stage in stages])),
+        mean_x_pos=float(np.mean([stage['mean_x_pos'] for stage in stages])),
+        clear_rate=float(np.mean([stage['clear_rate'] for stage in stages])),
+        stages=results['stages'],
+    )
+
+
+def sweep(checkpoints, config, num_workers, cache):
+    """Summary of every checkpoint, evaluating only those missing from the cache"""
+    hashes = {checkpoint: cache.hash(checkpoint) for checkpoint in checkpoints}
+    # a copy shares the result of its original
+    missing = list({sha256: checkpoint for checkpoint, sha256 in hashes.items() if cache.get(sha256, config) is None}.values())
+    per_round = max(1, num_workers // len(config['stages']))
+    for start in range(0, len(missing), per_round):
+        batch = missing[start:start + per_round]
+        results = evaluate_many(batch, config['stages'], config['episodes'], num_workers, config['epsilon'])
+        for checkpoint, result in zip(batch, results):
+            summary = summarize(result)
+            cache.put(hashes[checkpoint], config, summary)
+            print(
+                f"{checkpoint} - "
+                f"Mean Reward {summary['mean_reward']:.1f} - "
+                f"Mean x_pos {summary['mean_x_pos']:.1f} - "
+                f"Clear Rate {summary['clear_rate']:.0%} - "
+                f"Evaluated {start + len(batch)}/{len(missing)}"
+            )
+    cache.save()
+    return [(checkpoint, cache.get(hashes[checkpoint], config)) for checkpoint in checkpoints]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Evaluate and rank all checkpoints")
+    parser.add_argument('--root', type=Path, default=Path('checkpoints'))
+    parser.add_argument('--stages', nargs='+', default=['SuperMarioBros-1-1-v0'])
+    parser.add_argument('--episodes', type=int, default=5, help="per stage")
+    # the emulator is deterministic, a greedy policy would play the same episode every time
+    parser.add_argument('--epsilon', type=float, default=0.05)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--sort', choices=['mean_reward', 'mean_x_pos', 'clear_rate'], default='mean_reward')
+    parser.add_argument('--cache', type=Path, default=CACHE)
+    args = parser.parse_args()
+
+    config = dict(stages=args.stages, episodes=args.episodes, epsilon=args.epsilon)
+    rows = sweep(find_checkpoints(args.root), config, args.workers, ResultsCache(args.cache))
+    rows.sort(key=lambda row: row[1][args.sort], reverse=True)
+
+    width = max([len(str(checkpoint)) for checkpoint, _ in rows] + [10])
+    print(f"{'Rank':>4}  {'Checkpoint':<{width}}{'MeanReward':>12}{'MeanXPos':>10}{'Clear':>8}")
+    for rank, (checkpoint, summary) in enumerate(rows, 1):
+        print(
+            f"{rank:4d}  {str(checkpoint):<{width}}{summary['mean_reward']:12.1f}"
+            f"{summary['mean_x_pos']:10.1f}{summary['clear_rate']:8.0%}"
+        )
@@ -0,0 +1,54 @@
+import pytest
+import torch
+
+from checkpoint import CheckpointWriter, snapshot
+
+
+def test_snapshot_clones_tensors():
+    weight = torch.ones(3)
+    state = snapshot(dict(model={"weight": weight}, steps=[torch.zeros(1)], curr_step=5))
+    weight.add_(1)
+    assert state["model"]["weight"].tolist() == [1.0, 1.0, 1.0]
+    assert state["curr_step"] == 5 and isinstance(state["steps"], list)
+
+
+def test_write_replaces_the_checkpoint_atomically(tmp_path):
+    writer = CheckpointWriter(tmp_path)
+    path = tmp_path / "mario_net_1.chkpt"
+    writer.write(dict(curr_step=1, model=torch.zeros(2)), path)
+    writer.wait()
+    writer.write(dict(curr_step=2, model=torch.ones(2)), path)
+    writer.wait()
+    assert torch.load(path)["curr_step"] == 2
+    assert [p.name for p in tmp_path.iterdir()] == ["mario_net_1.chkpt"]
+
+    # a failed write leaves the previous checkpoint in place and is raised
+    writer.write(dict(curr_step=3, model=lambda: None), path)
+    with pytest.raises(Exception):
+        writer.wait()
+    assert torch.load(path)["curr_step"] == 2
+    writer.error = None
+    writer.close()
+
+
+def test_after_runs_once_the_checkpoint_is_on_disk(tmp_path):
+    writer = CheckpointWriter(tmp_path)
+    path = tmp_path / "mario_net_1.chkpt"
+    seen = []
+    writer.write(dict(curr_step=1), path, after=lambda: seen.append(path.exists()))
+    writer.close()
+    assert seen == [True]
+
+
+@pytest.mark.parametrize("keep_last, keep_every, kept", [
+    (None, None, list(range(1, 11))),
+    (3, None, [8, 9, 10]),
+    (2, 4, [4, 8, 9, 10]),
+    (None, 5, [5, 10]),
+])
+def test_prune(tmp_path, keep_last, keep_every, kept):
+    writer = CheckpointWriter(tmp_path, keep_last=keep_last, keep_every=keep_every)
+    for n in range(1, 11):
+        writer.write(dict(curr_step=n), tmp_path / f"mario_net_{n}.chkpt")
+    writer.close()
+    assert [n for n, _ in writer.checkpoints()] == kept
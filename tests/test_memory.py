@@ -0,0 +1,220 @@
+from functools import lru_cache
+
+import numpy as np
+import pytest
+
+from memory import BatchSampler, PrioritizedReplayBuffer, ReplayBuffer, SumTree
+
+STACK = 4
+
+
+@lru_cache(maxsize=None)
+def frame(number):
+    """8x8 frame encoding `number` in its first three pixels"""
+    f = np.zeros((8, 8), dtype=np.uint8)
+    f[0, :3] = number % 256, number // 256 % 256, number // 65536
+    return f
+
+
+def decode(frames):
+    frames = frames.astype(np.int64)
+    return frames[..., 0, 0] + 256 * frames[..., 0, 1] + 65536 * frames[..., 0, 2]
+
+
+def stack(first, t):
+    """Frame numbers of the stacked state at step t of an episode, the reset frame repeated"""
+    return np.array([first + max(t + j - STACK + 1, 0) for j in range(STACK)])
+
+
+def play(memory, streams, steps, seed=0, max_length=10):
+    """
+    Add `steps` transitions of `streams` interleaved envs, episodes of 2 to `max_length` steps
+
+    Frame k of an episode starting at frame number `first` holds first + k and
+    the action of step t is first + t, so every sampled transition can be checked.
+    """
+    rng = np.random.default_rng(seed)
+    episodes = {}
+    next_first = 0
+    for _ in range(steps):
+        stream = int(rng.integers(streams))
+        if stream not in episodes:
+            episodes[stream] = [next_first, 0, int(rng.integers(2, max_length + 1))]
+            next_first += 1000
+        first, t, length = episodes[stream]
+        state = np.stack([frame(k) for k in stack(first, t)])
+        next_state = np.stack([frame(k) for k in stack(first, t + 1)])
+        done = t + 1 == length
+        memory.add(state, next_state, first + t, 1.0, done, stream=stream)
+        if done:
+            del episodes[stream]
+        else:
+            episodes[stream][1] += 1
+
+
+def check_batch(memory, batch_size):
+    """Every sampled transition holds the frames of its own episode"""
+    idx, _ = memory.sample_idx(batch_size)
+    state, next_state, action, _, _ = memory.gather(idx)
+    first, t = action - action % 1000, action % 1000
+    expected = np.stack([stack(f, s) for f, s in zip(first, t)])
+    np.testing.assert_array_equal(decode(state), expected)
+    expected_next = np.stack([stack(f, s + memory.n_step) for f, s in zip(first, t)])
+    # an n-step transition ending the episode bootstraps from its last state
+    ends = memory.done[idx]
+    np.testing.assert_array_equal(decode(next_state)[~ends], expected_next[~ends])
+
+
+@pytest.mark.parametrize("buffer", [ReplayBuffer, PrioritizedReplayBuffer])
+@pytest.mark.parametrize("streams, capacity", [(1, 1000), (8, 2000), (16, 1000)])
+def test_interleaved_streams_never_sample_overwritten_frames(buffer, streams, capacity):
+    memory = buffer(capacity, (STACK, 8, 8))
+    play(memory, streams, 6000)
+    for _ in range(50):
+        check_batch(memory, 64)
+
+
+def test_stale_priority_updates_are_skipped():
+    memory = PrioritizedReplayBuffer(100, (STACK, 8, 8))
+    play(memory, 1, 100)
+    idx, _ = memory.sample_idx(32)
+    numbers = memory.transition_numbers(idx)
+    play(memory, 1, 150, seed=1)
+
+    before = memory.priorities[np.arange(100)].copy()
+    memory.update_priorities(numbers, np.full(32, 100.0))
+    np.testing.assert_array_equal(memory.priorities[np.arange(100)], before)
+    assert memory.max_priority == 1.0
+
+    idx, _ = memory.sample_idx(4)
+    memory.update_priorities(memory.transition_numbers(idx), np.full(4, 100.0))
+    assert (memory.priorities[idx] > 1.0).all()
+
+
+def test_sumtree_find_skips_empty_leaves():
+    tree = SumTree(8)
+    tree.update(np.arange(8), [1.0, 2.0, 0.1, 0.2, 0.0, 0.0, 0.0, 0.0])
+    # the largest value below the total, where rounding used to reach the empty right half
+    idx = tree.find([np.nextafter(tree.total, 0), tree.total])
+    assert (tree[idx] > 0).all()
+
+
+def test_batch_sampler_close_stops_the_prefetch_thread():
+    memory = ReplayBuffer(1000, (STACK, 8, 8))
+    play(memory, 2, 200)
+    sampler = BatchSampler(memory, 16, prefetch=True, slots=2)
+    _, _, state, *_ = sampler.get()
+    assert state.shape == (16, STACK, 8, 8)
+    # the other slot is filled, the thread now waits for a free one
+    sampler.close()
+    assert not sampler.thread.is_alive()
+
+
+def episode(first, length):
+    """(state, next_state) of every step of an episode of `length` steps"""
+    for t in range(length):
+        yield np.stack([frame(k) for k in stack(first, t)]), np.stack([frame(k) for k in stack(first, t + 1)])
+
+
+def test_episode_boundaries():
+    memory = ReplayBuffer(100, (STACK, 8, 8))
+    for first, length in ((0, 3), (1000, 5)):
+        for t, (state, next_state) in enumerate(episode(first, length)):
+            memory.add(state, next_state, first + t, float(t), t + 1 == length)
+
+    assert len(memory) == 8
+    # the repeated reset frame of a new episode is stored once, later steps add a single frame
+    assert memory.frame_count == (1 + 3) + (1 + 5)
+    state, next_state, action, reward, done = memory.gather(np.arange(8))
+    np.testing.assert_array_equal(action, [0, 1, 2, 1000, 1001, 1002, 1003, 1004])
+    np.testing.assert_array_equal(done, [False, False, True, False, False, False, False, True])
+    np.testing.assert_array_equal(decode(state[3]), stack(1000, 0))
+    np.testing.assert_array_equal(decode(next_state[2]), stack(0, 3))
+    np.testing.assert_array_equal(reward, [0, 1, 2, 0, 1, 2, 3, 4])
+
+
+def test_wrap_keeps_only_the_newest_transitions():
+    memory = ReplayBuffer(50, (STACK, 8, 8))
+    play(memory, 1, 400, max_length=30)
+    assert memory.count == 400
+    assert 0 < len(memory) <= 50
+    assert memory.tail == memory.count - len(memory)
+    # the live transitions are the newest ones, each with its own frames
+    state, _, action, _, _ = memory.gather(np.arange(memory.tail, memory.count) % memory.capacity)
+    assert (np.diff(action.astype(np.int64)) != 0).all()
+    first, t = action - action % 1000, action % 1000
+    np.testing.assert_array_equal(decode(state), np.stack([stack(f, s) for f, s in zip(first, t)]))
+    with pytest.raises(ValueError):
+        memory.sample_idx(len(memory) + 1)
+
+
+def test_n_step_returns():
+    gamma = 0.5
+    memory = ReplayBuffer(100, (STACK, 8, 8), n_step=3, gamma=gamma)
+    rewards = [1.0, 2.0, 4.0, 8.0, 16.0]
+    for t, (state, next_state) in enumerate(episode(0, 5)):
+        memory.add(state, next_state, t, rewards[t], t == 4)
+
+    # committed once 3 rewards are known, or at the end of the episode
+    assert len(memory) == 5
+    state, next_state, action, reward, done = memory.gather(np.arange(5))
+    np.testing.assert_array_equal(action, [0, 1, 2, 3, 4])
+    expected = [sum(gamma ** k * r for k, r in enumerate(rewards[t:t + 3])) for t in range(5)]
+    np.testing.assert_allclose(reward, expected)
+    np.testing.assert_array_equal(done, [False, False, True, True, True])
+    for t in range(5):
+        np.testing.assert_array_equal(decode(next_state[t]), stack(0, min(t + 3, 5)))
+
+
+def test_n_step_drops_steps_of_a_cut_episode():
+    memory = ReplayBuffer(100, (STACK, 8, 8), n_step=3)
+    steps = list(episode(0, 4))
+    for t, (state, next_state) in enumerate(steps[:2]):
+        memory.add(state, next_state, t, 1.0, False)
+    # a reset without `done`, the two pending steps never get 3 rewards
+    for t, (state, next_state) in enumerate(episode(1000, 3)):
+        memory.add(state, next_state, 1000 + t, 1.0, t == 2)
+    _, _, action, _, _ = memory.gather(np.arange(len(memory)))
+    np.testing.assert_array_equal(action, [1000, 1001, 1002])
+
+
+def test_snapshot_round_trip(tmp_path):
+    memory = ReplayBuffer(200, (STACK, 8, 8))
+    play(memory, 4, 500)
+    memory.save(tmp_path / "snapshot")
+
+    restored = ReplayBuffer(200, (STACK, 8, 8))
+    restored.restore(tmp_path / "snapshot")
+    assert (restored.count, restored.tail, restored.frame_count) == (memory.count, memory.tail, memory.frame_count)
+    idx, _ = memory.sample_idx(64)
+    for expected, actual in zip(memory.gather(idx), restored.gather(idx)):
+        np.testing.assert_array_equal(expected, actual)
+    check_batch(restored, 64)
+
+
+def test_sumtree_find_is_proportional_to_priority():
+    tree = SumTree(5)
+    priorities = np.array([1.0, 2.0, 3.0, 0.0, 4.0])
+    tree.update(np.arange(5), priorities)
+    assert tree.total == pytest.approx(10.0)
+
+    value = np.random.default_rng(0).random(100000) * tree.total
+    counts = np.bincount(tree.find(value), minlength=5)
+    np.testing.assert_allclose(counts / counts.sum(), priorities / priorities.sum(), atol=0.01)
+
+
+def test_prioritized_sampling_follows_priorities():
+    memory = PrioritizedReplayBuffer(200, (STACK, 8, 8), alpha=1.0)
+    play(memory, 1, 100)
+    live = memory.transition_numbers(np.arange(100))
+    high = live[:10]
+    memory.update_priorities(live, np.where(np.isin(live, high), 99.0, 1.0) - memory.eps)
+
+    counts = np.zeros(100)
+    for _ in range(200):
+        idx, weights = memory.sample_idx(32)
+        np.add.at(counts, idx, 1)
+        # the most likely transitions get the smallest weights
+        assert weights.min() == pytest.approx(weights[np.argmax(memory.priorities[idx])])
+    share = counts[high % 100].sum() / counts.sum()
+    assert share == pytest.approx(10 * 99 / (10 * 99 + 90), abs=0.05)
@@ -0,0 +1,37 @@
+import numpy as np
+
+from metrics import ColumnLog, MetricLogger, RollingMean, read_column
+
+
+def test_rolling_mean_matches_the_window():
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=1000) * 1e6
+    rolling = RollingMean(window=100)
+    assert np.isnan(rolling.mean)
+    for i, value in enumerate(values):
+        rolling.append(value)
+        assert np.isclose(rolling.mean, values[max(0, i - 99):i + 1].mean())
+
+
+def test_column_log_round_trip(tmp_path):
+    log = ColumnLog(tmp_path / "steps", dict(step="i8", reward="f4"), chunk_rows=4)
+    assert len(read_column(tmp_path / "steps", "reward")) == 0
+    for step in range(10):
+        log.append(step=step, reward=step / 2)
+    # two full chunks written, two rows still buffered
+    np.testing.assert_array_equal(read_column(tmp_path / "steps", "step"), np.arange(8))
+    log.flush()
+    reward = read_column(tmp_path / "steps", "reward")
+    assert reward.dtype == np.float32
+    np.testing.assert_array_equal(reward, np.arange(10) / 2)
+
+
+def test_metric_logger_steps_line_up_with_records(tmp_path):
+    logger = MetricLogger(tmp_path, num_envs=2)
+    for step in range(1, 4):
+        for env in range(2):
+            logger.log_step(1.0, None, None, step, env=env)
+    logger.close()
+    steps = tmp_path / "metrics" / "steps"
+    np.testing.assert_array_equal(read_column(steps, "step"), [1, 1, 2, 2, 3, 3])
+    np.testing.assert_array_equal(read_column(steps, "env"), [0, 1] * 3)
@@ -0,0 +1,54 @@
+import sqlite3
+
+import runs
+
+HEADER = f"{'Episode':>8}{'Step':>8}{'Epsilon':>10}{'MeanReward':>15}{'MeanLength':>15}{'MeanLoss':>15}{'MeanQValue':>15}{'TimeDelta':>15}{'Time':>20}\n"
+
+
+def line(episode, step, reward):
+    """A record as MetricLogger.record writes it"""
+    return (
+        f"{episode:8d}{step:8d}{0.5:10.3f}{reward:15.3f}{10.0:15.3f}{0.1:15.3f}{1.0:15.3f}"
+        f"{2.0:15.3f}{'2025-01-01T00:00:00':>20}\n"
+    )
+
+
+def test_parse_line():
+    assert runs.parse_line(HEADER) is None
+    assert runs.parse_line(line(3, 120, 42.0)) == (3, 120, 0.5, 42.0, 10.0, 0.1, 1.0, 2.0, "2025-01-01T00:00:00")
+    # a step filling its column runs into the episode
+    assert runs.parse_line(line(3, 12345678, 1.0))[:2] == (3, 12345678)
+
+
+def test_refresh_parses_only_what_changed(tmp_path):
+    run = tmp_path / "checkpoints" / "2025-01-01T00-00-00"
+    run.mkdir(parents=True)
+    log = run / "log"
+    log.write_text(HEADER + line(0, 10, 1.0) + line(1, 20, 2.0))
+    (run / "mario_net_1.chkpt").touch()
+    roots = (tmp_path / "checkpoints",)
+
+    db = sqlite3.connect(":memory:")
+    db.executescript(runs.SCHEMA)
+    assert runs.refresh(db, roots) == 1
+    assert runs.refresh(db, roots) == 0
+
+    # appended with a partly written last line, parsed once complete
+    with open(log, "a") as f:
+        f.write(line(2, 30, 5.0) + line(3, 40, 3.0)[:20])
+    assert runs.refresh(db, roots) == 1
+    assert db.execute("SELECT COUNT(*), MAX(mean_reward) FROM records").fetchone() == (3, 5.0)
+    with open(log, "a") as f:
+        f.write(line(3, 40, 3.0)[20:])
+    runs.refresh(db, roots)
+    assert db.execute("SELECT step FROM records ORDER BY step").fetchall() == [(10,), (20,), (30,), (40,)]
+    assert db.execute("SELECT checkpoints FROM runs").fetchone() == (1,)
+
+    # rewritten shorter: parsed again from the start
+    log.write_text(HEADER + line(0, 10, 7.0))
+    runs.refresh(db, roots)
+    assert db.execute("SELECT step, mean_reward FROM records").fetchall() == [(10, 7.0)]
+
+    log.unlink()
+    runs.refresh(db, roots)
+    assert db.execute("SELECT COUNT(*) FROM runs").fetchone() == (0,)
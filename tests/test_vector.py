@@ -0,0 +1,54 @@
+from functools import partial
+
+import numpy as np
+from gym.spaces import Discrete
+
+from vector import SubprocVecEnv
+
+
+class CountingEnv:
+    '''Observation filled with (seed, step), episodes of `length` steps, reward = action'''
+    action_space = Discrete(3)
+
+    def __init__(self, seed, length):
+        self.seed = seed
+        self.length = length
+        self.t = 0
+
+    def observation(self):
+        return np.array([[self.seed, self.t]], dtype=np.uint8)
+
+    def reset(self):
+        self.t = 0
+        return self.observation()
+
+    def step(self, action):
+        self.t += 1
+        return self.observation(), float(action), self.t == self.length, dict(t=self.t)
+
+    def close(self):
+        pass
+
+
+def test_step_auto_reset_and_banks():
+    env = SubprocVecEnv([partial(CountingEnv, seed, length) for seed, length in ((1, 2), (2, 3))])
+    try:
+        assert env.obs_shape == (1, 2) and env.action_space.n == 3
+        obs = env.reset()
+        np.testing.assert_array_equal(obs[:, 0], [[1, 0], [2, 0]])
+
+        first, rewards, dones, _ = env.step([1, 2])
+        np.testing.assert_array_equal(rewards, [1.0, 2.0])
+        np.testing.assert_array_equal(first[:, 0, 1], [1, 1])
+
+        second, _, dones, infos = env.step([0, 0])
+        # env 0 ended: reset, its last observation in the info
+        np.testing.assert_array_equal(dones, [True, False])
+        np.testing.assert_array_equal(infos[0]["terminal_observation"], [[1, 2]])
+        assert "terminal_observation" not in infos[1]
+        np.testing.assert_array_equal(second[:, 0, 1], [0, 2])
+        # the previous observations stay valid until the step after next
+        np.testing.assert_array_equal(first[:, 0, 1], [1, 1])
+    finally:
+        env.close()
+    env.close()
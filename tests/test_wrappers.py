@@ -0,0 +1,69 @@
+import gym
+import numpy as np
+import pytest
+from gym.spaces import Box, Discrete
+
+from wrappers import SaveStatePool
+
+
+class RunningEnv(gym.Env):
+    '''Mario running right at `speed` x_pos per step, counting its steps and backups'''
+    observation_space = Box(0, 255, (1,), dtype=np.uint8)
+    action_space = Discrete(2)
+
+    def __init__(self, speed=10):
+        self.speed = speed
+        self.x_pos = 0
+        self.steps = 0
+        self.backups = 0
+
+    def reset(self, **kwargs):
+        self.x_pos = 0
+        return np.zeros(1, dtype=np.uint8)
+
+    def step(self, action):
+        self.steps += 1
+        self.x_pos += self.speed
+        return np.zeros(1, dtype=np.uint8), 1.0, False, dict(x_pos=self.x_pos, flag_get=False)
+
+    def _backup(self):
+        self.backups += 1
+
+
+def play(pool, steps):
+    pool.reset()
+    for _ in range(steps):
+        pool.step(0)
+
+
+def test_captures_a_savestate_once_passed():
+    envs = [RunningEnv(), RunningEnv()]
+    pool = SaveStatePool(envs, [100], random_start=True)
+    play(pool, 20)
+    assert pool.captured == [0, 1]
+    # replayed once, up to the first step past the checkpoint
+    assert (envs[1].steps, envs[1].backups) == (10, 1)
+
+
+def test_failed_capture_is_attempted_once_per_episode():
+    # the replay falls short of the checkpoint, e.g. a non-deterministic emulator
+    envs = [RunningEnv(), RunningEnv(speed=5)]
+    pool = SaveStatePool(envs, [100], random_start=True)
+    play(pool, 50)
+    assert pool.captured == [0]
+    assert envs[1].steps == 10
+    play(pool, 50)
+    assert envs[1].steps == 20
+
+
+def test_no_capture_without_random_start():
+    envs = [RunningEnv(), RunningEnv()]
+    pool = SaveStatePool(envs, [100])
+    play(pool, 50)
+    assert pool.captured == [0]
+    assert envs[1].steps == 0
+
+
+def test_needs_one_env_per_start_point():
+    with pytest.raises(ValueError):
+        SaveStatePool([RunningEnv()], [100])
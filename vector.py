@@ -0,0 +1,118 @@
+import multiprocessing as mp
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+
+def _worker(remote, parent_remote, env_fn):
+    parent_remote.close()
+    env = env_fn()
+    obs = np.asarray(env.reset())
+    remote.send((obs.shape, obs.dtype.str, env.action_space))
+
+    # The parent allocates the shared observations once every worker reported its spec
+    shm_name, index, num_envs = remote.recv()
+    shm = shared_memory.SharedMemory(name=shm_name)
+    banks = np.ndarray((2, num_envs) + obs.shape, dtype=obs.dtype, buffer=shm.buf)
+    banks[0, index] = obs
+    remote.send(None)
+    try:
+        while True:
+            cmd, bank, data = remote.recv()
+            if cmd == 'step':
+                obs, reward, done, info = env.step(data)
+                if done or info.get('flag_get'):
+                    # Auto-reset, the caller still needs the last observation to cache it
+                    info['terminal_observation'] = np.array(obs)
+                    obs = env.reset()
+                banks[bank, index] = obs
+                remote.send((reward, done, info))
+            elif cmd == 'reset':
+                banks[bank, index] = env.reset()
+                remote.send(None)
+            elif cmd == 'close':
+                break
+    finally:
+        env.close()
+        del banks
+        shm.close()
+        remote.close()
+
+
+class SubprocVecEnv:
+    '''Run `len(env_fns)` envs in worker processes and step them together
+
+    Observations are written by the workers into shared memory and returned as
+    an array of shape (num_envs, *obs_shape) without pickling. Two banks
+    alternate between steps, so the observations returned by one call stay
+    valid until the call after next, which is what `cache(state, next_state)`
+    needs.
+
+    An env is reset as soon as its episode ends (`done` or `flag_get`, like the
+    main loop). Its final observation is then in `info['terminal_observation']`
+    and the returned observation is the first one of the next episode.
+    '''
+    def __init__(self, env_fns):
+        # Workers are forked and must inherit the parent's resource tracker,
+        # with their own one the shared memory is unlinked when they exit.
+        ctx = mp.get_context('fork')
+        resource_tracker.ensure_running()
+        self.num_envs = len(env_fns)
+        self.remotes, self.processes = [], []
+        for env_fn in env_fns:
+            remote, work_remote = ctx.Pipe()
+            process = ctx.Process(target=_worker, args=(work_remote, remote, env_fn), daemon=True)
+            process.start()
+            work_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+
+        specs = [remote.recv() for remote in self.remotes]
+        if len(set(spec[:2] for spec in specs)) != 1:
+            raise ValueError(f"All envs must share one observation spec, got {set(spec[:2] for spec in specs)}")
+        shape, dtype, self.action_space = specs[0]
+        self.obs_shape, self.obs_dtype = tuple(shape), np.dtype(dtype)
+
+        nbytes = 2 * self.num_envs * int(np.prod(self.obs_shape)) * self.obs_dtype.itemsize
+        self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.banks = np.ndarray((2, self.num_envs) + self.obs_shape, dtype=self.obs_dtype, buffer=self.shm.buf)
+        for index, remote in enumerate(self.remotes):
+            remote.send((self.shm.name, index, self.num_envs))
+        for remote in self.remotes:
+            remote.recv()
+        self.bank = 0
+        self.closed = False
+
+    def reset(self):
+        self.bank ^= 1
+        for remote in self.remotes:
+            remote.send(('reset', self.bank, None))
+        for remote in self.remotes:
+            remote.recv()
+        return self.banks[self.bank]
+
+    def step(self, actions):
+        """
+        Step every env with its action
+
+        Outputs:
+        obs (array of shape (num_envs, *obs_shape)), rewards, dones (arrays of shape (num_envs,)), infos (list of dict)
+        """
+        self.bank ^= 1
+        for remote, action in zip(self.remotes, actions):
+            remote.send(('step', self.bank, int(action)))
+        results = [remote.recv() for remote in self.remotes]
+        rewards, dones, infos = zip(*results)
+        return self.banks[self.bank], np.array(rewards, dtype=np.float64), np.array(dones, dtype=np.bool_), list(infos)
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(('close', None, None))
+        for process in self.processes:
+            process.join()
+        del self.banks
+        self.shm.close()
+        self.shm.unlink()
+        self.closed = True
@@ -1,5 +1,6 @@
 import gym
 import torch
+import cv2
 import random, datetime, numpy as np
 from skimage import transform
 
@@ -24,6 +25,171 @@ class ResizeObservation(gym.ObservationWrapper):
         return resize_obs
 
 
+class PreprocessObservation(gym.ObservationWrapper):
+    '''Crop, grayscale and area-resize an RGB frame in one pass, output stays uint8
+
+    Replaces GrayScaleObservation -> ResizeObservation -> TransformObservation(x / 255.),
+    scaling to [0, 1] is left to the network input. The grayscale image and the
+    outputs are written into preallocated buffers; returned frames are reused
+    after `num_buffers` steps, which covers FrameStack and the state/next_state pair.
+    '''
+    def __init__(self, env, shape, crop=None, num_buffers=16):
+        """
+        crop (tuple): optional (top, bottom, left, right) pixel bounds kept from the frame
+        """
+        super().__init__(env)
+        if isinstance(shape, int):
+            self.shape = (shape, shape)
+        else:
+            self.shape = tuple(shape)
+        self.observation_space = Box(low=0, high=255, shape=self.shape, dtype=np.uint8)
+
+        height, width = env.observation_space.shape[:2]
+        top, bottom, left, right = crop if crop is not None else (0, height, 0, width)
+        self.crop = (slice(top, bottom), slice(left, right))
+        self.gray = np.empty((height, width), dtype=np.uint8)
+        self.buffers = np.empty((num_buffers,) + self.shape, dtype=np.uint8)
+        self.index = 0
+
+    def observation(self, observation):
+        cv2.cvtColor(observation, cv2.COLOR_RGB2GRAY, dst=self.gray)
+        out = self.buffers[self.index]
+        self.index = (self.index + 1) % len(self.buffers)
+        # cv2 takes the output size as (width, height)
+        cv2.resize(self.gray[self.crop], self.shape[::-1], dst=out, interpolation=cv2.INTER_AREA)
+        return out
+
+
+class RingFrameStack(gym.Wrapper):
+    '''Stack the last `num_stack` frames as a uint8 view, without LazyFrames
+
+    Frames are appended to a fixed array of `num_stack * buffer_stacks` slots and
+    the observation is the contiguous slice ending at the newest frame, so it goes
+    straight to `torch.from_numpy`. When the array is full, the last frames are
+    copied to its start; a returned observation therefore stays valid for
+    `num_stack * (buffer_stacks - 1)` steps, enough for `cache(state, next_state)`.
+
+    Every frame gets an id, repeated frames of a reset share one. `info['frame_ids']`
+    holds the ids of the oldest frame of `state` followed by the frames of
+    `next_state`, so a replay buffer can tell which frames it already stores.
+    '''
+    def __init__(self, env, num_stack, buffer_stacks=16):
+        super().__init__(env)
+        self.num_stack = num_stack
+        frame_shape = env.observation_space.shape
+        self.observation_space = Box(low=0, high=255, shape=(num_stack,) + frame_shape, dtype=np.uint8)
+        self.frames = np.empty((num_stack * buffer_stacks,) + frame_shape, dtype=np.uint8)
+        self.ids = np.empty(len(self.frames), dtype=np.int64)
+        self.pos = 0  # index after the newest frame
+        self.next_id = 0
+
+    def _append(self, frame, frame_id):
+        if self.pos == len(self.frames):
+            keep = self.num_stack - 1
+            self.frames[:keep] = self.frames[self.pos - keep:self.pos]
+            self.ids[:keep] = self.ids[self.pos - keep:self.pos]
+            self.pos = keep
+        self.frames[self.pos] = frame
+        self.ids[self.pos] = frame_id
+        self.pos += 1
+
+    @property
+    def frame_ids(self):
+        """Ids of the frames of the current observation"""
+        return self.ids[self.pos - self.num_stack:self.pos].copy()
+
+    def observation(self):
+        return self.frames[self.pos - self.num_stack:self.pos]
+
+    def reset(self, **kwargs):
+        frame = self.env.reset(**kwargs)
+        for _ in range(self.num_stack):
+            self._append(frame, self.next_id)
+        self.next_id += 1
+        return self.observation()
+
+    def step(self, action):
+        frame, reward, done, info = self.env.step(action)
+        previous_id = self.ids[self.pos - self.num_stack]
+        self._append(frame, self.next_id)
+        self.next_id += 1
+        info['frame_ids'] = np.append(previous_id, self.frame_ids)
+        return self.observation(), reward, done, info
+
+
+class SaveStatePool(gym.Wrapper):
+    '''Start episodes from emulator savestates at the level start and at x_pos checkpoints
+
+    nes_py keeps a single backup per emulator, which SuperMarioBrosEnv takes right
+    after the start screen and restores on every reset. The pool holds one raw
+    env per start point: `envs[0]` keeps the level start, `envs[i]` gets a backup
+    once an episode first passes `checkpoints[i - 1]`, by replaying the recorded
+    NES actions of that episode in it (the emulator is deterministic). Resetting
+    then only restores the chosen backup. A start point is attempted at most once
+    per episode, and only with `random_start`, the only user of the backups.
+
+    Wrap the raw envs directly, below JoypadSpace, so the recorded actions are
+    per-frame NES button bytes.
+    '''
+    def __init__(self, envs, checkpoints, random_start=False):
+        """
+        envs (list): one raw SuperMarioBrosEnv per start point, len(checkpoints) + 1
+        checkpoints (list of int): x_pos of the mid-level start points
+        random_start (bool): start each episode at a uniformly chosen captured start point
+        """
+        if len(envs) != len(checkpoints) + 1:
+            raise ValueError(f"Expecting {len(checkpoints) + 1} envs for {len(checkpoints)} checkpoints, got {len(envs)}")
+        super().__init__(envs[0])
+        self.envs = envs
+        self.checkpoints = [0] + sorted(checkpoints)
+        self.random_start = random_start
+        # NES actions leading from the level start to each start point, None until captured
+        self.prefixes = [[]] + [None] * len(checkpoints)
+        self.start = 0
+        self.actions = []
+        self.attempted = set()
+
+    @property
+    def captured(self):
+        return [i for i, prefix in enumerate(self.prefixes) if prefix is not None]
+
+    def reset(self, **kwargs):
+        self.start = np.random.choice(self.captured) if self.random_start else 0
+        self.env = self.envs[self.start]
+        self.actions = list(self.prefixes[self.start])
+        self.attempted = set()
+        return self.env.reset(**kwargs)
+
+    def step(self, action):
+        obs, reward, done, info = self.env.step(action)
+        self.actions.append(action)
+        info['start_x_pos'] = self.checkpoints[self.start]
+        if self.random_start and not done:
+            for i in range(self.start + 1, len(self.checkpoints)):
+                if self.prefixes[i] is None and i not in self.attempted and info['x_pos'] >= self.checkpoints[i]:
+                    # replaying the episode again on every later frame would cost O(n^2) steps
+                    self.attempted.add(i)
+                    self._capture(i)
+        return obs, reward, done, info
+
+    def _capture(self, i):
+        """Replay the current episode in envs[i] and back its emulator up there"""
+        env = self.envs[i]
+        env.reset()
+        for action in self.actions:
+            _, _, done, info = env.step(action)
+            if done:
+                return
+        if info['x_pos'] < self.checkpoints[i]:
+            return
+        env.unwrapped._backup()
+        self.prefixes[i] = list(self.actions)
+
+    def close(self):
+        for env in self.envs:
+            env.close()
+
+
 class SkipFrame(gym.Wrapper):
     def __init__(self, env, skip):
         """Return only every `skip`-th frame"""
@@ -41,3 +207,37 @@ class SkipFrame(gym.Wrapper):
             if done:
                 break
         return obs, total_reward, done, info
+
+
+def make_env(stage='SuperMarioBros-1-1-v0', skip=4, shape=84, num_stack=4, checkpoints=None, random_start=False):
+    """
+    Build the wrapped Mario env used for training and evaluation
+
+    checkpoints (list of int): x_pos of mid-level savestates, see SaveStatePool
+    random_start (bool): start episodes at a random captured savestate, without it no savestate is captured
+    """
+    import gym_super_mario_bros
+    from nes_py.wrappers import JoypadSpace
+
+    if checkpoints and random_start:
+        env = SaveStatePool(
+            [gym_super_mario_bros.make(stage) for _ in range(len(checkpoints) + 1)],
+            checkpoints,
+            random_start=random_start
+        )
+    else:
+        env = gym_super_mario_bros.make(stage)
+
+    # Limit the action-space to
+    #   0. walk right
+    #   1. jump right
+    env = JoypadSpace(
+        env,
+        [['right'],
+        ['right', 'A']]
+    )
+
+    env = SkipFrame(env, skip=skip)
+    env = PreprocessObservation(env, shape=shape)
+    env = RingFrameStack(env, num_stack=num_stack)
+    return env